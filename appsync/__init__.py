@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 import traceback
 from ConfigParser import NoSectionError
 
@@ -11,6 +12,7 @@ from pyramid.settings import asbool
 from mozsvc.config import get_configurator
 from mozsvc.plugin import load_and_register
 
+from appsync.metrics import metrics
 from appsync.storage import StorageAuthError, ConnectionError, ServerError
 
 
@@ -36,8 +38,38 @@ def includeme(config):
     except NoSectionError:
         pass
 
+    # initializes the changes notifier
+    try:
+        load_and_register("notifier", config)
+    except NoSectionError:
+        pass
+
+
+def _route_name(request):
+    """Returns the name under which a request is measured."""
+    path = request.path_info
+    if path == '/verify':
+        return 'verify'
+    if path.startswith('/collections/'):
+        if path.endswith('/changes'):
+            return 'changes'
+        return 'data.' + request.method
+    if path == '/__heartbeat__':
+        return 'heartbeat'
+    if path == '/__stats__':
+        return 'stats'
+    return 'other'
+
 
 class CatchAuthError(object):
+    """Converts the storage errors into 401s and 503s, and measures each
+    request.
+
+    The time spent is recorded under request.<route>, and under
+    request.<route>.<part> for the parts (storage, cache...) that were
+    timed while serving it. The statuses are counted under status.<code>
+    and the bytes sent under bytes.<route>.
+    """
     def __init__(self, app, retry_after='120'):
         self.app = app
         if isinstance(retry_after, int):
@@ -46,6 +78,26 @@ class CatchAuthError(object):
 
     @wsgify
     def __call__(self, request):
+        route = _route_name(request)
+        status = 500
+        size = None
+        metrics.start_request()
+        start = time.time()
+        try:
+            response = self._get_response(request)
+            status = response.status_int
+            size = response.content_length
+            return response
+        finally:
+            metrics.timing('request.' + route, time.time() - start)
+            for part, duration in metrics.end_request().items():
+                metrics.timing('request.%s.%s' % (route, part), duration)
+            metrics.incr('status.%d' % status)
+            # streamed responses have no length
+            if size is not None:
+                metrics.incr('bytes.' + route, size)
+
+    def _get_response(self, request):
         try:
             return request.get_response(self.app)
         except (HTTPUnauthorized, StorageAuthError), e:
@@ -6,6 +6,7 @@ from base64 import urlsafe_b64decode as b64dec
 
 from webob.exc import HTTPUnauthorized
 from appsync import logger
+from appsync.util import get_storage
 
 
 def check_auth(request):
@@ -59,6 +60,15 @@ def check_auth(request):
                      'user=%r' % (username, user))
         raise HTTPUnauthorized('Invalid user')
 
+    # a signed token can be checked right away, and must be the user's
+    signer = getattr(get_storage(request), 'token_signer', None)
+    if signer is not None:
+        res = signer.verify(dbtoken)
+        if res is not None and res[0] != user:
+            logger.error('Attempted auth for user=%r with a token for '
+                         'user=%r' % (user, res[0]))
+            raise HTTPUnauthorized('Invalid user')
+
     # need to verify the user signature here
     # XXX
     return user, collection, dbtoken
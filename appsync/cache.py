@@ -2,9 +2,17 @@ from pylibmc import Client, NotFound, ThreadMappedPool
 from pylibmc import Error as MemcachedError
 import threading
 import thread
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict     # NOQA
 
 from zope.interface import Interface, implements
 
+from appsync import logger
+from appsync.metrics import metrics
+
 
 class CacheError(Exception):
     pass
@@ -21,21 +29,73 @@ class IAppCache(Interface):
     def get(key):
         """get a key"""
 
+    def get_multi(keys):
+        """Get several keys at once, returns a dict of the ones found"""
+
     def delete(key):
         """"Delete a key"""
 
+    def delete_multi(keys):
+        """Delete several keys at once"""
+
     def incr(key, size=1):
         """Increment a counter"""
 
     def set(key, value, time=0):
         """Set a key"""
 
-    def get_set(key, func):
+    def add(key, value, time=0):
+        """Set a key if it's not set yet, returns True if it was set"""
+
+    def set_multi(mapping, time=0):
+        """Set several keys at once"""
+
+    def get_set(key, func, time=0):
         """GetSet a key"""
 
+    def get_set_entry(key, func, time=0):
+        """Like get_set, but returns a (value, expires) tuple. `expires`
+        is the time the value goes stale, or None if it does not"""
+
+    def set_computed(key, value, time=0):
+        """Set a key read with get_set"""
+
+
+# tags the values set by get_set, so any other tuple is not taken for one
+_ENTRY = 'appsync:entry'
+
+
+def _entry(value):
+    """Returns the (value, expires) tuple set by get_set, or None."""
+    tagged = isinstance(value, tuple) and len(value) == 3
+    if tagged and value[0] == _ENTRY:
+        return value[1:]
+    return None
+
+
+def _fresh(entry):
+    expires = entry[1]
+    return expires is None or expires > time.time()
+
+
+def _expires(ttl):
+    return time.time() + ttl
+
 
 class Cache(object):
     """ Helpers on the top of pylibmc
+
+    get_set() makes sure only one client computes a missing or expired
+    value at a time, across all the processes: the client that gets a
+    lease in memcached (held `lease_ttl` seconds at most) computes it.
+    Meanwhile, the other clients get the expired value, which is kept
+    `stale_ttl` more seconds, or wait up to `lease_wait` seconds for the
+    new one when there's none.
+
+    The keys read with get_set() hold (value, expires) tuples, so they
+    are written with set_computed() rather than set(). Their callers put
+    a version in those keys, to change that format without mixing the
+    values of two versions of the code during a deploy.
     """
     implements(IAppCache)
 
@@ -43,12 +103,11 @@ class Cache(object):
         self.servers = [server.strip()
                         for server in options['servers'].split(',')]
         self.prefix = options['prefix']
+        self.lease_ttl = int(options.get('lease_ttl', 10))
+        self.lease_wait = float(options.get('lease_wait', .5))
+        self.stale_ttl = int(options.get('stale_ttl', 60))
         self._client = Client(self.servers)
         self.pool = ThreadMappedPool(self._client)
-        # using a locker to avoid race conditions
-        # when several clients for the same user
-        # get/set the cached data
-        self._locker = threading.RLock()
 
     def _key(self, *key):
         return ':'.join([self.prefix] + list(key))
@@ -63,49 +122,326 @@ class Cache(object):
     def get(self, key):
         key = self._key(key)
 
-        with self.pool.reserve() as mc:
-            try:
-                return mc.get(key)
-            except MemcachedError, err:
-                # memcache seems down
-                raise CacheError(str(err))
+        with metrics.timer('cache.get', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.get(key)
+                except MemcachedError, err:
+                    # memcache seems down
+                    raise CacheError(str(err))
+
+    def get_multi(self, keys):
+        with metrics.timer('cache.get_multi', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.get_multi(keys, key_prefix=self._key(''))
+                except MemcachedError, err:
+                    # memcache seems down
+                    raise CacheError(str(err))
 
     def delete(self, key):
         key = self._key(key)
 
-        with self.pool.reserve() as mc:
-            try:
-                return mc.delete(key)
-            except NotFound:
-                return False
-            except MemcachedError, err:
-                # memcache seems down
-                raise CacheError(str(err))
+        with metrics.timer('cache.delete', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.delete(key)
+                except NotFound:
+                    return False
+                except MemcachedError, err:
+                    # memcache seems down
+                    raise CacheError(str(err))
+
+    def delete_multi(self, keys):
+        with metrics.timer('cache.delete_multi', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.delete_multi(keys, key_prefix=self._key(''))
+                except MemcachedError, err:
+                    raise CacheError(str(err))
 
     def incr(self, key, size=1):
         key = self._key(key)
 
+        with metrics.timer('cache.incr', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.incr(key, size)
+                except NotFound:
+                    return mc.set(key, size)
+                except MemcachedError, err:
+                    raise CacheError(str(err))
+
+    def set(self, key, value, time=0):
+        key = self._key(key)
+
+        with metrics.timer('cache.set', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    if not mc.set(key, value, time=time):
+                        raise CacheError()
+                except MemcachedError, err:
+                    raise CacheError(str(err))
+
+    def add(self, key, value, time=0):
+        key = self._key(key)
+
+        with metrics.timer('cache.add', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    return mc.add(key, value, time=time)
+                except MemcachedError, err:
+                    raise CacheError(str(err))
+
+    def set_multi(self, mapping, time=0):
+        with metrics.timer('cache.set_multi', part='cache'):
+            with self.pool.reserve() as mc:
+                try:
+                    failed = mc.set_multi(mapping, time=time,
+                                          key_prefix=self._key(''))
+                except MemcachedError, err:
+                    raise CacheError(str(err))
+        if failed:
+            raise CacheError('Could not set %s' % ', '.join(failed))
+
+    def get_set(self, key, func, time=0):
+        return self.get_set_entry(key, func, time)[0]
+
+    def get_set_entry(self, key, func, time=0):
+        entry = _entry(self.get(key))
+        if entry is not None and _fresh(entry):
+            return entry
+
+        if self._acquire_lease(key):
+            try:
+                return self._compute(key, func, time)
+            finally:
+                try:
+                    self._release_lease(key)
+                except CacheError:
+                    # the lease expires anyway, the value is not lost
+                    logger.error('Unable to release the lease of %s' % key)
+
+        # someone else is computing it
+        if entry is not None:
+            metrics.incr('cache.get_set.stale')
+            return entry
+
+        metrics.incr('cache.get_set.waits')
+        entry = self._wait_for(key)
+        if entry is not None:
+            return entry
+        # it takes too long
+        return self._compute(key, func, time)
+
+    def set_computed(self, key, value, time=0):
+        if time:
+            # the value is kept a bit longer, to be served while it's
+            # computed again
+            entry = value, _expires(time)
+            self.set(key, (_ENTRY,) + entry, time=time + self.stale_ttl)
+        else:
+            entry = value, None
+            self.set(key, (_ENTRY,) + entry)
+        return entry
+
+    def _compute(self, key, func, ttl):
+        metrics.incr('cache.get_set.computed')
+        return self.set_computed(key, func(), ttl)
+
+    def _wait_for(self, key):
+        deadline = time.time() + self.lease_wait
+        while time.time() < deadline:
+            time.sleep(.05)
+            entry = _entry(self.get(key))
+            if entry is not None:
+                return entry
+        return None
+
+    def _acquire_lease(self, key):
+        key = self._key('lease', key)
         with self.pool.reserve() as mc:
             try:
-                return mc.incr(key, size)
-            except NotFound:
-                return mc.set(key, size)
+                return mc.add(key, 1, time=self.lease_ttl)
             except MemcachedError, err:
                 raise CacheError(str(err))
 
-    def set(self, key, value, time=0):
-        key = self._key(key)
-
+    def _release_lease(self, key):
+        key = self._key('lease', key)
         with self.pool.reserve() as mc:
             try:
-                if not mc.set(key, value, time=time):
-                    raise CacheError()
+                mc.delete(key)
+            except NotFound:
+                pass
             except MemcachedError, err:
                 raise CacheError(str(err))
 
-    def get_set(self, key, func):
-        res = self.get(key)
-        if res is None:
-            res = func()
-            self.set(key, res)
+
+class LocalCache(object):
+    """In-process LRU tier in front of another cache.
+
+    Up to `size` keys recently read or written are kept in memory for
+    `ttl` seconds, or less when they are set with a shorter time. A key
+    expiring in the other cache can still be served from memory for up
+    to `ttl` seconds.
+
+    When given, `keep(key)` tells which keys can be kept in memory, the
+    others are always read from the other cache.
+    """
+    implements(IAppCache)
+
+    def __init__(self, cache, size=1000, ttl=5, keep=None):
+        self.cache = cache
+        self.size = size
+        self.ttl = ttl
+        self.keep = keep
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _kept(self, key):
+        return self.keep is None or self.keep(key)
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # the most recently used keys are kept at the end
+            self._items[key] = expires, value
+            return value
+
+    def _set_local(self, key, value, ttl):
+        if not self._kept(key):
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = time.time() + ttl, value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def _delete_local(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def cleanup(self):
+        self.cache.cleanup()
+
+    def flush_all(self):
+        with self._lock:
+            self._items.clear()
+        self.cache.flush_all()
+
+    def get(self, key):
+        if not self._kept(key):
+            return self.cache.get(key)
+
+        res = self._get_local(key)
+        if res is not None:
+            metrics.incr('cache.local.hits')
+            return res
+
+        metrics.incr('cache.local.misses')
+        res = self.cache.get(key)
+        if res is not None:
+            self._set_local(key, res, self.ttl)
         return res
+
+    def get_multi(self, keys):
+        res = {}
+        missing = []
+        remote = []
+        for key in keys:
+            if not self._kept(key):
+                remote.append(key)
+                continue
+            value = self._get_local(key)
+            if value is None:
+                missing.append(key)
+            else:
+                res[key] = value
+        metrics.incr('cache.local.hits', len(res))
+        if missing:
+            metrics.incr('cache.local.misses', len(missing))
+        elif not remote:
+            return res
+
+        found = self.cache.get_multi(missing + remote)
+        for key, value in found.items():
+            self._set_local(key, value, self.ttl)
+        res.update(found)
+        return res
+
+    def delete(self, key):
+        self._delete_local(key)
+        return self.cache.delete(key)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._delete_local(key)
+        return self.cache.delete_multi(keys)
+
+    def incr(self, key, size=1):
+        self._delete_local(key)
+        return self.cache.incr(key, size)
+
+    def set(self, key, value, time=0):
+        self.cache.set(key, value, time=time)
+        if time:
+            ttl = min(time, self.ttl)
+        else:
+            ttl = self.ttl
+        self._set_local(key, value, ttl)
+
+    def add(self, key, value, time=0):
+        added = self.cache.add(key, value, time=time)
+        if added:
+            if time:
+                ttl = min(time, self.ttl)
+            else:
+                ttl = self.ttl
+            self._set_local(key, value, ttl)
+        return added
+
+    def set_multi(self, mapping, time=0):
+        self.cache.set_multi(mapping, time=time)
+        if time:
+            ttl = min(time, self.ttl)
+        else:
+            ttl = self.ttl
+        for key, value in mapping.items():
+            self._set_local(key, value, ttl)
+
+    def get_set(self, key, func, time=0):
+        return self.get_set_entry(key, func, time)[0]
+
+    def get_set_entry(self, key, func, time=0):
+        if not self._kept(key):
+            return self.cache.get_set_entry(key, func, time=time)
+
+        entry = self._get_local(key)
+        if entry is not None:
+            metrics.incr('cache.local.hits')
+            return entry
+
+        metrics.incr('cache.local.misses')
+        entry = self.cache.get_set_entry(key, func, time=time)
+        self._set_local_entry(key, entry)
+        return entry
+
+    def set_computed(self, key, value, time=0):
+        entry = self.cache.set_computed(key, value, time=time)
+        self._set_local_entry(key, entry)
+        return entry
+
+    def _set_local_entry(self, key, entry):
+        # a stale value is not kept, the next call may get the new one
+        expires = entry[1]
+        if expires is None:
+            self._set_local(key, entry, self.ttl)
+        else:
+            ttl = min(expires - time.time(), self.ttl)
+            if ttl > 0:
+                self._set_local(key, entry, ttl)
@@ -0,0 +1,151 @@
+""" In-process metrics.
+
+Counters, gauges and timers are kept in memory by each process and
+returned by snapshot().
+
+Timings can also be summed per part (storage, cache...) for the request
+being served by the current thread, between start_request() and
+end_request().
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds of the timers buckets, in milliseconds
+BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Timer(object):
+    """Distribution of durations, in milliseconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = self.max = None
+        # the last bucket holds everything above BUCKETS[-1]
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration):
+        duration = duration * 1000
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+        for index, limit in enumerate(BUCKETS):
+            if duration <= limit:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+
+    def percentile(self, ratio):
+        """Returns the upper bound of the bucket holding that percentile."""
+        if self.count == 0:
+            return None
+        rank = self.count * ratio
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                break
+        if index == len(BUCKETS):
+            return self.max
+        return min(BUCKETS[index], self.max)
+
+    def to_dict(self):
+        if self.count == 0:
+            avg = None
+        else:
+            avg = self.total / self.count
+
+        buckets = {}
+        for index, count in enumerate(self.buckets):
+            if index == len(BUCKETS):
+                buckets['inf'] = count
+            else:
+                buckets[str(BUCKETS[index])] = count
+
+        return {'count': self.count, 'avg': avg, 'min': self.min,
+                'max': self.max, 'p50': self.percentile(.5),
+                'p90': self.percentile(.9), 'p99': self.percentile(.99),
+                'buckets': buckets}
+
+
+class Metrics(object):
+    """Registry of counters, gauges and timers, safe across threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._timers = {}
+
+    def incr(self, name, size=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + size
+
+    def gauge(self, name, value):
+        """Sets a gauge. If value is a callable, it's called by snapshot()"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def timing(self, name, duration, part=None):
+        """Records a duration, in seconds.
+
+        If part is given, the duration is also added to the time spent
+        in that part by the current request.
+        """
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = Timer()
+            timer.add(duration)
+
+        if part is not None:
+            parts = getattr(self._local, 'parts', None)
+            if parts is not None:
+                parts[part] = parts.get(part, 0) + duration
+
+    @contextmanager
+    def timer(self, name, part=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start, part)
+
+    def start_request(self):
+        """Starts summing the time spent in each part by this thread."""
+        self._local.parts = {}
+
+    def end_request(self):
+        """Returns the time spent in each part since start_request()."""
+        parts = getattr(self._local, 'parts', None)
+        self._local.parts = None
+        return parts or {}
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timers = dict((name, timer.to_dict())
+                          for name, timer in self._timers.items())
+
+        for name, value in gauges.items():
+            if callable(value):
+                gauges[name] = value()
+
+        return {'counters': counters, 'gauges': gauges, 'timers': timers}
+
+
+# the metrics of this process
+metrics = Metrics()
@@ -0,0 +1,56 @@
+""" Notifications of the changes made to the collections.
+"""
+import threading
+from contextlib import contextmanager
+
+from zope.interface import Interface, implements
+
+
+class INotifier(Interface):
+
+    def publish(user, collection):
+        """Wakes up the listeners of a collection that changed"""
+
+    def listen(user, collection):
+        """Context manager returning an event set when the collection
+        changes, until the block exits"""
+
+
+class LocalNotifier(object):
+    """Notifies the listeners of the current process.
+
+    Configuration example::
+
+        [notifier]
+        backend = appsync.notify.LocalNotifier
+
+    The changes made by the other processes are not seen, so the
+    listeners have to check the storage from time to time too.
+    """
+    implements(INotifier)
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    def publish(self, user, collection):
+        with self._lock:
+            events = self._listeners.pop((user, collection), [])
+        for event in events:
+            event.set()
+
+    @contextmanager
+    def listen(self, user, collection):
+        key = user, collection
+        event = threading.Event()
+        with self._lock:
+            self._listeners.setdefault(key, []).append(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                events = self._listeners.get(key, [])
+                if event in events:
+                    events.remove(event)
+                    if not events:
+                        del self._listeners[key]
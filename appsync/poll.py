@@ -0,0 +1,139 @@
+""" Computes the X-Sync-Poll value sent to the clients.
+
+The value set in memcached by appsync-backoff is kept in memory, and
+read again every `poll_cache_ttl` seconds by a background thread, or by
+the first request after that delay with `poll_refresh_thread = false`.
+
+With `poll_adaptive = true` in the [global] section, the value is also
+computed for each collection: the clients are told to poll after
+`poll_activity_ratio` times the time since the collection last changed,
+so idle collections are polled less often than active ones. The result
+is multiplied by the load factor of the process, which grows when the
+latency of the data GETs goes over `poll_target_latency` seconds, or
+their rate over `poll_target_rate` per second (0 to ignore them). The
+value is kept between `poll_min` and `poll_max`, and never goes below
+the value set by appsync-backoff.
+"""
+import threading
+import time
+
+from pyramid.settings import asbool
+
+from appsync.metrics import metrics
+from appsync.util import RefreshedValue
+
+
+class Load(object):
+    """Rate and latency of the requests of this process.
+
+    The latency is a moving average. The rate is the one of the last
+    `window` seconds.
+    """
+    def __init__(self, window=10., alpha=.05):
+        self.window = window
+        self.alpha = alpha
+        self.latency = 0.
+        self.rate = 0.
+        self._count = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        elapsed = time.time() - self._start
+        if elapsed >= self.window:
+            self.rate = self._count / elapsed
+            self._count = 0
+            self._start += elapsed
+
+    def record(self, duration):
+        with self._lock:
+            self._roll()
+            self._count += 1
+            self.latency += self.alpha * (duration - self.latency)
+
+    def get_rate(self):
+        with self._lock:
+            self._roll()
+            return self.rate
+
+
+class PollPolicy(object):
+    """Decides the poll interval of the clients."""
+
+    def __init__(self, adaptive=False, min_interval=10, max_interval=600,
+                 activity_ratio=.1, target_latency=.5, target_rate=0,
+                 cache_ttl=60, refresh_thread=True):
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.activity_ratio = activity_ratio
+        self.target_latency = target_latency
+        self.target_rate = target_rate
+        self.cache_ttl = cache_ttl
+        self.refresh_thread = refresh_thread
+        self.load = Load()
+        self._global = None
+
+        metrics.gauge('poll.global', self._get_cached_global)
+        metrics.gauge('poll.latency', lambda: self.load.latency)
+        metrics.gauge('poll.rate', self.load.get_rate)
+        metrics.gauge('poll.load_factor', self.load_factor)
+
+    @classmethod
+    def from_settings(cls, settings):
+        def option(name, default):
+            return float(settings.get('global.poll_' + name, default))
+
+        return cls(adaptive=asbool(settings.get('global.poll_adaptive',
+                                                False)),
+                   min_interval=option('min', 10),
+                   max_interval=option('max', 600),
+                   activity_ratio=option('activity_ratio', .1),
+                   target_latency=option('target_latency', .5),
+                   target_rate=option('target_rate', 0),
+                   cache_ttl=option('cache_ttl', 60),
+                   refresh_thread=asbool(settings.get(
+                       'global.poll_refresh_thread', True)))
+
+    def _get_cached_global(self):
+        if self._global is None:
+            return None
+        return self._global.value
+
+    def get_global(self, cache):
+        """Returns the value set by appsync-backoff, or None"""
+        if cache is None:
+            return None
+        if self._global is None:
+            self._global = RefreshedValue('poll.global',
+                                          lambda: cache.get('X-Sync-Poll'),
+                                          self.cache_ttl,
+                                          background=self.refresh_thread)
+        return self._global.get()
+
+    def load_factor(self):
+        factor = 1.
+        if self.target_latency:
+            factor = max(factor, self.load.latency / self.target_latency)
+        if self.target_rate:
+            factor = max(factor, self.load.get_rate() / self.target_rate)
+        return factor
+
+    def get_interval(self, cache, last_modified=None):
+        """Returns the poll interval for a collection, or None.
+
+        `last_modified` is the last time the collection changed, if any.
+        """
+        interval = self.get_global(cache)
+        if not self.adaptive:
+            return interval
+
+        if last_modified is None:
+            computed = self.max_interval
+        else:
+            idle = max(time.time() - float(last_modified), 0)
+            computed = idle * self.activity_ratio * self.load_factor()
+        computed = min(max(computed, self.min_interval), self.max_interval)
+        if interval is not None:
+            computed = max(computed, interval)
+        return int(computed)
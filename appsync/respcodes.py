@@ -3,3 +3,5 @@
 INVALID_JSON = 0            # Invalid json
 INVALID_SINCE_VALUE = 1     # Invalid value for Since
 MISSING_VALUE = 2           # missing value
+INVALID_TIMEOUT_VALUE = 3   # Invalid value for timeout
+INVALID_ORIGIN = 4          # Origin missing or too long
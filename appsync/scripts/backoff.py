@@ -5,13 +5,31 @@ except ImportError:
     print("You need to install pylibmc")
     sys.exit(1)
 
+import json
+import urllib2
 from optparse import OptionParser
 
 _KEY = 'appsync:X-Sync-Poll'
 
 
+def show_stats(url):
+    """Prints the poll values computed by a server, from its /__stats__"""
+    url = url.rstrip('/') + '/__stats__'
+    try:
+        gauges = json.load(urllib2.urlopen(url))['gauges']
+    except (urllib2.URLError, ValueError, KeyError), e:
+        print("Could not read %s: %s" % (url, e))
+        sys.exit(1)
+
+    # these are the values of the process that answered
+    print("Backoff in use: %s" % gauges.get('poll.global'))
+    print("Requests per second: %.2f" % gauges.get('poll.rate', 0))
+    print("Average latency: %.3f seconds" % gauges.get('poll.latency', 0))
+    print("Load factor: %.2f" % gauges.get('poll.load_factor', 1))
+
+
 def main():
-    usage = "usage: %prog [options] get|set value|del"
+    usage = "usage: %prog [options] get|set value|del|stats server_url"
     parser = OptionParser(usage=usage)
     parser.add_option("-m", "--memcached", dest="memcached",
                       help="Memcache server",
@@ -23,14 +41,18 @@ def main():
 
     action = args[0]
 
-    if action not in ('get', 'set', 'del'):
+    if action not in ('get', 'set', 'del', 'stats'):
         parser.print_help()
         sys.exit(1)
 
-    if action == 'set' and len(args) < 2:
+    if action in ('set', 'stats') and len(args) < 2:
         parser.print_help()
         sys.exit(1)
 
+    if action == 'stats':
+        show_stats(args[1])
+        sys.exit(0)
+
     try:
         client = pylibmc.Client([options.memcached])
     except ValueError:
@@ -0,0 +1,41 @@
+import sys
+import logging
+from optparse import OptionParser
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from appsync.storage.sql import _TABLES, create_indexes, has_unique_origins
+
+
+def main():
+    usage = "usage: %prog [options] sqluri"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+                      help="Only print the errors", default=False)
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("You need to give the database URI")
+
+    if not options.quiet:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    engine = create_engine(args[0])
+    try:
+        # the new tables are created with their indexes
+        for table in _TABLES:
+            table.create(bind=engine, checkfirst=True)
+        created = create_indexes(engine)
+    except SQLAlchemyError, e:
+        print("The migration failed: %s" % e)
+        sys.exit(1)
+
+    if not options.quiet:
+        print("%d index(es) created." % len(created))
+        if has_unique_origins(engine):
+            print("The applications can be upserted.")
+
+
+if __name__ == '__main__':
+    main()
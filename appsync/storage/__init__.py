@@ -1,7 +1,12 @@
 
+from mozsvc.util import resolve_name
 from zope.interface import Interface
 
 
+# the longest user, collection or origin the backends can index
+MAX_KEY_LENGTH = 255
+
+
 class CollectionDeletedError(Exception):
     """Error raised when accessing a collection that has been deleted."""
     def __init__(self, client_id, reason):
@@ -82,10 +87,12 @@ class IAppSyncDatabase(Interface):
     def get_applications(user, collection, since, token):
         """Get all applications that have been modified later than 'since'.
 
-        This method returns a list of all applications from the specified
-        collection that have been modified later than time 'since'.  It
-        may return multiple entries per application and they need not be in
-        any particular order.
+        This method returns an iterable (possibly a generator, read only
+        once) of all applications from the specified collection that have
+        been modified later than time 'since', as (last_modified,
+        application) pairs.  It may return multiple entries
+        per application, and they are sorted by increasing modification
+        time so that responses can be split in several pages.
         """
 
     def add_applications(user, collection, applications, token):
@@ -104,3 +111,18 @@ class IAppSyncDatabase(Interface):
         When set to False, verify raises a NotImplementedError and
         other APIs don't check the token.
         """
+
+
+def load_backend(name, options):
+    """Creates the backend configured by the `name` option, with the
+    `name.xxx` options.
+    """
+    klass = resolve_name(options[name])
+    klass_options = {}
+    for key, value in options.items():
+        if not key.startswith(name + '.'):
+            continue
+        key = key.split('.', 1)[-1]
+        klass_options[key] = value
+
+    return klass(**klass_options)
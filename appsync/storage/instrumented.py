@@ -0,0 +1,141 @@
+""" Backend measuring the calls made to another backend.
+
+Configuration example::
+
+    [storage]
+    backend = appsync.storage.instrumented.InstrumentedDatabase
+    instrumented = true
+    inner = appsync.storage.sql.SQLDatabase
+    inner.sqluri = sqlite:////tmp/appsync.db
+
+For each method, the latency is recorded under storage.<method>, and the
+errors under storage.<method>.errors.<type>. For the methods returning
+applications, this includes reading them, which may be done lazily. The
+applications returned and received are counted under
+storage.<method>.apps.
+
+When instrumented is false, the methods of the inner backend are called
+directly.
+"""
+import time
+
+from pyramid.settings import asbool
+from zope.interface import implements
+
+from appsync.metrics import metrics
+from appsync.storage import IAppSyncDatabase, load_backend
+
+
+_METHODS = ('verify', 'get_last_modified', 'delete', 'get_uuid',
+            'get_applications', 'add_applications', 'set_authentication')
+
+
+class InstrumentedDatabase(object):
+    implements(IAppSyncDatabase)
+
+    def __init__(self, **options):
+        self._inner = load_backend('inner', options)
+        self.instrumented = asbool(options.get('instrumented', True))
+
+        if not self.instrumented:
+            for name in _METHODS:
+                setattr(self, name, getattr(self._inner, name))
+
+        # optional API
+        if hasattr(self._inner, 'get_collection_snapshot'):
+            if self.instrumented:
+                self.get_collection_snapshot = self._get_collection_snapshot
+            else:
+                self.get_collection_snapshot = \
+                        self._inner.get_collection_snapshot
+
+    def __getattr__(self, name):
+        # the other attributes are the inner backend's ones
+        if name == '_inner':
+            raise AttributeError(name)
+        return getattr(self._inner, name)
+
+    def _record(self, name, elapsed, error=None):
+        if error is not None:
+            metrics.incr('storage.%s.errors.%s' % (name,
+                                                   error.__class__.__name__))
+        metrics.timing('storage.' + name, elapsed)
+
+    def _call(self, name, *args, **kw):
+        res, elapsed = self._call_lazy(name, *args, **kw)
+        self._record(name, elapsed)
+        return res
+
+    def _call_lazy(self, name, *args, **kw):
+        """Calls a method returning apps that may be read lazily.
+
+        Returns the result and the time taken, which is recorded once the
+        apps are read. The errors are recorded right away.
+        """
+        start = time.time()
+        try:
+            res = getattr(self._inner, name)(*args, **kw)
+        except Exception, e:
+            self._record(name, time.time() - start, e)
+            raise
+        return res, time.time() - start
+
+    def _count(self, name, apps, elapsed):
+        """Yields the apps, counting them.
+
+        The time spent reading them is added to the one of the call, and
+        the errors met are recorded too.
+        """
+        apps = iter(apps)
+        count = 0
+        error = None
+        try:
+            while True:
+                start = time.time()
+                try:
+                    app = apps.next()
+                except StopIteration:
+                    break
+                except Exception, error:
+                    raise
+                finally:
+                    elapsed += time.time() - start
+                count += 1
+                yield app
+        finally:
+            # releases the cursor when we're closed before the end
+            if hasattr(apps, 'close'):
+                apps.close()
+            metrics.incr('storage.%s.apps' % name, count)
+            self._record(name, elapsed, error)
+
+    def verify(self, *args, **kw):
+        return self._call('verify', *args, **kw)
+
+    def get_last_modified(self, *args, **kw):
+        return self._call('get_last_modified', *args, **kw)
+
+    def delete(self, *args, **kw):
+        return self._call('delete', *args, **kw)
+
+    def get_uuid(self, *args, **kw):
+        return self._call('get_uuid', *args, **kw)
+
+    def get_applications(self, *args, **kw):
+        apps, elapsed = self._call_lazy('get_applications', *args, **kw)
+        return self._count('get_applications', apps, elapsed)
+
+    def _get_collection_snapshot(self, *args, **kw):
+        res, elapsed = self._call_lazy('get_collection_snapshot', *args,
+                                       **kw)
+        uuid, last_modified, apps = res
+        return uuid, last_modified, self._count('get_collection_snapshot',
+                                                apps, elapsed)
+
+    def add_applications(self, user, collection, applications, token):
+        metrics.incr('storage.add_applications.apps', len(applications))
+        return self._call('add_applications', user, collection,
+                          applications, token)
+
+    def set_authentication(self, state):
+        return self._call('set_authentication', state)
@@ -0,0 +1,165 @@
+""" Append-only journal of the writes to apply later on a backend.
+"""
+import fcntl
+import os
+import threading
+import traceback
+from contextlib import contextmanager
+
+import simplejson as json
+
+from appsync import logger
+
+
+# the end of the journal is checked by chunks of that size
+_CHUNK = 64 * 1024
+
+
+class Journal(object):
+    """Keeps writes in a file until they are replayed.
+
+    The writes are appended as JSON lines, and synced on disk every
+    `fsync_every` writes or when sync() is called. The position of the
+    first write not replayed yet is kept in a `.offset` file next to the
+    journal. After a crash some writes may be replayed twice, so they
+    have to be idempotent.
+
+    Several processes (like the gunicorn workers) can share a journal:
+    the appends are done under an exclusive flock() of the journal, and
+    the replays under one of a `.lock` file, so a single process replays
+    the writes at a time.
+    """
+    def __init__(self, path, fsync_every=10):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._unsynced = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0644)
+        self._lock_file = open(path + '.lock', 'a')
+        with self._locked():
+            self._repair()
+
+    @contextmanager
+    def _locked(self):
+        # flock() does not lock out the threads sharing the descriptor
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _get_size(self):
+        return os.fstat(self._fd).st_size
+
+    def _repair(self):
+        # a crash may have left half a line at the end
+        size = end = self._get_size()
+        with open(self.path, 'rb') as f:
+            while end > 0:
+                start = max(end - _CHUNK, 0)
+                f.seek(start)
+                chunk = f.read(end - start)
+                if end == size and chunk.endswith('\n'):
+                    return
+                pos = chunk.rfind('\n')
+                if pos != -1:
+                    end = start + pos + 1
+                    break
+                end = start
+        if end == size:
+            return
+        os.ftruncate(self._fd, end)
+        logger.error('Removed a partial write from %s' % self.path)
+
+    def _read_offset(self, size):
+        try:
+            with open(self.path + '.offset') as f:
+                return min(int(f.read()), size)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = '%s.offset.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.rename(tmp, self.path + '.offset')
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+
+    def sync(self):
+        """Syncs the appended writes on disk."""
+        with self._lock:
+            self._sync()
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self._locked():
+            # a single write, so the other processes never see half a line
+            os.write(self._fd, line)
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+
+    def pending(self):
+        """Returns the size of the writes not replayed yet, in bytes."""
+        size = self._get_size()
+        return size - self._read_offset(size)
+
+    def replay(self, apply):
+        """Calls apply(record) on the writes not replayed yet, in order.
+
+        Stops at the first error, and returns the number of writes that
+        were replayed.
+        """
+        with self._replay_lock:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                return self._replay(apply)
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _replay(self, apply):
+        count = 0
+        offset = self._read_offset(self._get_size())
+        with open(self.path, 'rb') as reader:
+            while True:
+                with self._locked():
+                    if offset >= self._get_size():
+                        # all replayed, the journal can start over
+                        os.ftruncate(self._fd, 0)
+                        self._write_offset(0)
+                        return count
+                    reader.seek(offset)
+                    line = reader.readline()
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error('Skipped a corrupted write in %s: %r' %
+                                 (self.path, line))
+                else:
+                    try:
+                        apply(record)
+                    except Exception:
+                        logger.error(traceback.format_exc())
+                        break
+
+                offset += len(line)
+                count += 1
+                if count % self.fsync_every == 0:
+                    self._write_offset(offset)
+
+        self._write_offset(offset)
+        return count
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            os.close(self._fd)
+            self._lock_file.close()
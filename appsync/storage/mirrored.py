@@ -1,30 +1,433 @@
-from mozsvc.util import resolve_name
+import os
+import time
+import threading
+import traceback
+import functools
+from itertools import count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full, Empty
+
 from zope.interface import implements
-from appsync.storage import IAppSyncDatabase
+
+from appsync import logger
+from appsync.cache import CacheError
+from appsync.metrics import metrics
+from appsync.storage import (IAppSyncDatabase, CollectionDeletedError,
+                             StorageAuthError, load_backend)
+from appsync.storage.journal import Journal
+
+
+# errors that don't tell anything about the health of a backend
+_EXPECTED_ERRORS = (CollectionDeletedError, StorageAuthError)
+
+# one new collection out of _PROBE_EVERY goes to the slowest backend
+_PROBE_EVERY = 20
+
+_OTHER = {'readwrite': 'write', 'write': 'readwrite'}
+
+
+def _pin_key(user, collection):
+    return 'pin:%s:%s' % (user, collection)
+
+
+class Health(object):
+    """Recent latency and error rate of a backend, as moving averages."""
+
+    def __init__(self, alpha=.2):
+        self.alpha = alpha
+        self.latency = 0.
+        self.errors = 0.
+        self._lock = threading.Lock()
+
+    def record(self, duration, failed=False):
+        with self._lock:
+            self.latency += self.alpha * (duration - self.latency)
+            self.errors += self.alpha * (int(failed) - self.errors)
+
+    @property
+    def healthy(self):
+        return self.errors < .5
+
+    def score(self):
+        """The lower, the better."""
+        return (not self.healthy, self.latency * (1 + self.errors))
 
 
 class MirroredDatabase(object):
+    """Reads from the readwrite backend, and writes to both backends.
+
+    With `mirror_mode = async`, the writes on the write backend are done
+    by a background thread, so a slow or failing mirror does not affect
+    the clients. The pending writes are kept in a queue of `queue_size`
+    writes; when it's full the new writes are not mirrored. Each write is
+    tried `write_retries` more times, `retry_delay` seconds apart.
+
+    With a `journal` file, the writes that could not be mirrored are
+    appended to it instead of being lost, and the writes that follow
+    too, to keep them in order. The journal is replayed on the write
+    backend every `replay_interval` seconds. Each process remembers if
+    the journal holds writes, and only reads it again when it replays
+    it: the writes journaled by another process are noticed then.
+
+    `read_policy` decides where the collection snapshots are read:
+
+    - primary: the readwrite backend only (default)
+    - fastest: the backend with the best recent latency and error rate,
+      the other one being tried if it fails
+    - hedged: the readwrite backend, and the write backend too if no
+      answer came after `hedge_after` milliseconds. The first answer wins
+
+    The hedged reads are run by `hedge_threads` threads per process. When
+    they are all busy, the reads are done by the request, on one backend
+    then on the other if it fails.
+
+    Each backend has its own uuids and timestamps, so a `since` given by
+    one backend means nothing to the other. That's why only the snapshots,
+    which carry the uuid with the apps, can be read from both: a client
+    switched to the other backend sees a new uuid and downloads the
+    collection again. To keep that rare, each collection sticks to the
+    backend that last answered for it, for `pin_ttl` seconds. The pins are
+    kept in the cache of the readwrite backend, so all the processes
+    agree. The other reads always go to the readwrite backend.
+
+    The write backend does not check the tokens, so the readwrite backend
+    checks them (with its check_token method) before a read goes to the
+    write backend.
+    """
     implements(IAppSyncDatabase)
 
     def __init__(self, **options):
-        self._readwrite = self._backend('readwrite', options)
-        self._write = self._backend('write', options)
+        self._readwrite = load_backend('readwrite', options)
+        self._write = load_backend('write', options)
         self._write.set_authentication(False)
 
-    def _backend(self, name, options):
-        klass = resolve_name(options[name])
-        klass_options = {}
-        for key, value in options.items():
-            if not key.startswith(name + '.'):
-                continue
-            key = key.split('.', 1)[-1]
-            klass_options[key] = value
+        self.mirror_mode = options.get('mirror_mode', 'sync')
+        if self.mirror_mode not in ('sync', 'async'):
+            raise ValueError('Unknown mirror_mode %r' % self.mirror_mode)
+
+        if self.mirror_mode == 'async':
+            default_retries = 3
+        else:
+            # the clients are waiting
+            default_retries = 0
+        self.write_retries = int(options.get('write_retries',
+                                             default_retries))
+        self.retry_delay = float(options.get('retry_delay', 1))
+
+        journal = options.get('journal')
+        if journal is not None:
+            fsync_every = int(options.get('journal_fsync_every', 10))
+            self._journal = Journal(journal, fsync_every)
+            self._journaled = self._journal.pending() > 0
+            self._journaled_lock = threading.Lock()
+            self.replay_interval = float(options.get('replay_interval', 5))
+            metrics.gauge('mirror.journal.size', self._journal.pending)
+            worker = threading.Thread(target=self._replay_journal,
+                                      name='appsync-journal')
+            worker.daemon = True
+            worker.start()
+        else:
+            self._journal = None
+
+        if self.mirror_mode == 'async':
+            self._queue = Queue(int(options.get('queue_size', 1000)))
+            metrics.gauge('mirror.queue', self._queue.qsize)
+            worker = threading.Thread(target=self._mirror_writes,
+                                      name='appsync-mirror')
+            worker.daemon = True
+            worker.start()
+
+        self.read_policy = options.get('read_policy', 'primary')
+        if self.read_policy not in ('primary', 'fastest', 'hedged'):
+            raise ValueError('Unknown read_policy %r' % self.read_policy)
+        if self.read_policy != 'primary':
+            if not hasattr(self._readwrite, 'check_token'):
+                raise ValueError('The readwrite backend cannot check the '
+                                 'tokens of the reads sent to the write '
+                                 'backend')
+            for backend in (self._readwrite, self._write):
+                if not hasattr(backend, 'get_collection_snapshot'):
+                    raise ValueError('The %s read policy needs backends '
+                                     'with snapshots' % self.read_policy)
+            if getattr(self._readwrite, 'cache', None) is None:
+                raise ValueError('The readwrite backend has no cache to '
+                                 'keep the pins in')
+        self.hedge_after = float(options.get('hedge_after', 50)) / 1000
+        self.hedge_threads = int(options.get('hedge_threads', 20))
+        self._hedge_pool = self._hedge_pid = None
+        self._hedging = 0
+        self._hedge_lock = threading.Lock()
+        self.pin_ttl = int(options.get('pin_ttl', 3600))
+        self._health = {'readwrite': Health(), 'write': Health()}
+        self._reads = count(1)
+        for role, health in self._health.items():
+            metrics.gauge('mirror.%s.latency' % role,
+                          functools.partial(getattr, health, 'latency'))
+            metrics.gauge('mirror.%s.errors' % role,
+                          functools.partial(getattr, health, 'errors'))
+
+        # the tokens issued by the readwrite backend
+        self.token_signer = getattr(self._readwrite, 'token_signer', None)
+
+        # optional API
+        if hasattr(self._readwrite, 'get_collection_snapshot'):
+            if self.read_policy == 'primary':
+                self.get_collection_snapshot = \
+                        self._readwrite.get_collection_snapshot
+            else:
+                self.get_collection_snapshot = self._read_snapshot
+
+    def _mirror(self, name, *args, **kw):
+        if self.mirror_mode == 'sync':
+            if self._journal is None:
+                getattr(self._write, name)(*args, **kw)
+            else:
+                self._mirror_write(name, *args, **kw)
+            return
+
+        try:
+            self._queue.put_nowait((time.time(), name, args, kw))
+        except Full:
+            if self._journal is not None:
+                self._journal_write(name, args, kw)
+            else:
+                metrics.incr('mirror.dropped')
+                logger.error('The mirror queue is full, a write was dropped')
+
+    def _mirror_writes(self):
+        while True:
+            queued, name, args, kw = self._queue.get()
+            try:
+                self._mirror_write(name, *args, **kw)
+            finally:
+                # the time between the write on the readwrite backend
+                # and the write on the mirror
+                metrics.timing('mirror.lag', time.time() - queued)
+                self._queue.task_done()
+
+    def _mirror_write(self, name, *args, **kw):
+        # the older writes have to be replayed first
+        if self._journal is not None and self._journaled:
+            self._journal_write(name, args, kw)
+            return
+
+        for attempt in range(self.write_retries + 1):
+            if attempt > 0:
+                metrics.incr('mirror.retries')
+                time.sleep(self.retry_delay)
+            try:
+                getattr(self._write, name)(*args, **kw)
+                return
+            except Exception:
+                logger.error(traceback.format_exc())
+
+        if self._journal is not None:
+            self._journal_write(name, args, kw)
+            return
+
+        metrics.incr('mirror.failures')
+        logger.error('Could not mirror a write after %d attempts' %
+                     (self.write_retries + 1))
+
+    #
+    # journal
+    #
+    def _journal_write(self, name, args, kw):
+        # the write backend does not need the tokens, let's not keep them
+        args, kw = list(args), dict(kw)
+        positional = IAppSyncDatabase[name].positional
+        if 'token' in kw:
+            kw['token'] = None
+        elif 'token' in positional[:len(args)]:
+            args[positional.index('token')] = None
+        with self._journaled_lock:
+            self._journal.append({'name': name, 'args': args, 'kw': kw})
+            self._journaled = True
+        metrics.incr('mirror.journal.appended')
+
+    def _replay_write(self, record):
+        with metrics.timer('mirror.journal.replay'):
+            getattr(self._write, record['name'])(*record['args'],
+                                                 **record['kw'])
+
+    def _replay_journal(self):
+        while True:
+            time.sleep(self.replay_interval)
+            try:
+                self.replay()
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    def replay(self):
+        """Applies the journaled writes on the write backend."""
+        self._journal.sync()
+        replayed = 0
+        if self._journal.pending():
+            replayed = self._journal.replay(self._replay_write)
+            metrics.incr('mirror.journal.replayed', replayed)
+            if self._journal.pending():
+                logger.error('The journal could not be fully replayed')
+
+        # the other processes may have journaled writes meanwhile
+        with self._journaled_lock:
+            self._journaled = self._journal.pending() > 0
+        return replayed
+
+    #
+    # reads
+    #
+    def _get_pin(self, user, collection):
+        try:
+            return self._readwrite.cache.get(_pin_key(user, collection))
+        except CacheError:
+            logger.error('Unable to read the backend of a collection')
+            return None
+
+    def _pin(self, user, collection, role):
+        try:
+            self._readwrite.cache.set(_pin_key(user, collection), role,
+                                      time=self.pin_ttl)
+        except CacheError:
+            logger.error('Unable to keep the backend of a collection')
+
+    def _snapshot(self, role, user, collection, since, token):
+        """Reads a snapshot on a backend, recording its health.
+
+        The apps are all read here, so the errors happen before we
+        answer and the results are not used by another thread.
+        """
+        if role == 'write':
+            # this one trusts any token
+            self._readwrite.check_token(token)
+
+        backend = getattr(self, '_' + role)
+        start = time.time()
+        failed = False
+        try:
+            uuid, last_modified, apps = backend.get_collection_snapshot(
+                    user, collection, since, token=token)
+            return uuid, last_modified, list(apps)
+        except _EXPECTED_ERRORS:
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._health[role].record(time.time() - start, failed)
+
+    def _read_snapshot(self, user, collection, since, token):
+        if self.read_policy == 'fastest':
+            read = self._read_fastest
+        else:
+            read = self._read_hedged
+        pinned = self._get_pin(user, collection)
+        role, res = read(pinned, user, collection, since, token)
+        if role != pinned:
+            self._pin(user, collection, role)
+        return res
+
+    def _read_fastest(self, pinned, *args):
+        if pinned is None:
+            roles = sorted(('readwrite', 'write'),
+                           key=lambda role: self._health[role].score())
+            # once in a while, a new collection goes to the other backend
+            # so its health is known when it comes back
+            if self._reads.next() % _PROBE_EVERY == 0:
+                roles.reverse()
+        else:
+            roles = [pinned, _OTHER[pinned]]
+
+        try:
+            return roles[0], self._snapshot(roles[0], *args)
+        except _EXPECTED_ERRORS:
+            raise
+        except Exception:
+            logger.error(traceback.format_exc())
+            metrics.incr('mirror.failovers')
+            return roles[1], self._snapshot(roles[1], *args)
+
+    def _reserve_hedge(self, count):
+        """Reserves `count` threads of the hedging pool of this process.
+
+        Returns the pool, or None if it has not enough free threads. The
+        pool is created by the first read, because its threads would not
+        follow the server when it forks its workers.
+        """
+        with self._hedge_lock:
+            if self._hedge_pid != os.getpid():
+                self._hedge_pool = ThreadPool(self.hedge_threads)
+                self._hedge_pid = os.getpid()
+                self._hedging = 0
+            if self._hedging + count > self.hedge_threads:
+                return None
+            self._hedging += count
+            return self._hedge_pool
+
+    def _release_hedge(self):
+        with self._hedge_lock:
+            self._hedging -= 1
+
+    def _read_hedged(self, pinned, *args):
+        first = pinned or 'readwrite'
+
+        # each read may need two threads
+        pool = self._reserve_hedge(2)
+        if pool is None:
+            metrics.incr('mirror.hedge_full')
+            return self._read_fastest(first, *args)
+
+        answers = Queue()
+
+        def call(role):
+            try:
+                answers.put((role, True, self._snapshot(role, *args)))
+            except Exception, e:
+                answers.put((role, False, e))
+            finally:
+                self._release_hedge()
+
+        pool.apply_async(call, (first,))
+        hedged = True
+        try:
+            role, success, res = answers.get(timeout=self.hedge_after)
+        except Empty:
+            # the first backend is slow, let's ask the other one as well
+            metrics.incr('mirror.hedged')
+            pool.apply_async(call, (_OTHER[first],))
+            role, success, res = answers.get()
+        else:
+            if not success and not isinstance(res, _EXPECTED_ERRORS):
+                # it failed right away, let's ask the other one
+                metrics.incr('mirror.failovers')
+                pool.apply_async(call, (_OTHER[first],))
+            else:
+                hedged = False
+        if not hedged:
+            # the second thread is not needed
+            self._release_hedge()
+
+        if success:
+            return role, res
+        if isinstance(res, _EXPECTED_ERRORS):
+            raise res
+
+        # the first answer is an error, the other one is our last chance
+        logger.error(str(res))
+        role, success, res = answers.get()
+        if success:
+            return role, res
+        raise res
 
-        return klass(**klass_options)
+    def flush(self):
+        """Waits for the pending writes to be mirrored."""
+        if self.mirror_mode == 'async':
+            self._queue.join()
+        if self._journal is not None:
+            self.replay()
 
     def delete(self, *args, **kw):
         self._readwrite.delete(*args, **kw)
-        self._write.delete(*args, **kw)
+        self._mirror('delete', *args, **kw)
 
     def get_uuid(self, *args, **kw):
         return self._readwrite.get_uuid(*args, **kw)
@@ -34,7 +437,7 @@ class MirroredDatabase(object):
 
     def add_applications(self, *args, **kw):
         self._readwrite.add_applications(*args, **kw)
-        self._write.add_applications(*args, **kw)
+        self._mirror('add_applications', *args, **kw)
 
     def get_last_modified(self, *args, **kw):
         return self._readwrite.get_last_modified(*args, **kw)
@@ -96,6 +96,56 @@ order by
 """
 
 
+# the uuid, last modified time and deleted state of a collection
+GET_METADATA = """\
+select
+    (select uuid from collections
+     where user = :user and collection = :collection
+     limit 1) as uuid,
+    (select max(last_modified) from applications
+     where user = :user and collection = :collection) as last_modified,
+    (select client_id from deleted
+     where user = :user and collection = :collection
+     limit 1) as client_id,
+    (select reason from deleted
+     where user = :user and collection = :collection
+     limit 1) as reason
+"""
+
+
+# the collection metadata, repeated on each app modified since :since
+# (or on a single row with no app)
+GET_SNAPSHOT = """\
+select
+    meta.uuid, meta.last_modified as collection_modified,
+    meta.client_id, meta.reason, apps.last_modified, apps.data
+from
+    (select
+        (select uuid from collections
+         where user = :user and collection = :collection
+         limit 1) as uuid,
+        (select max(last_modified) from applications
+         where user = :user and collection = :collection) as last_modified,
+        (select client_id from deleted
+         where user = :user and collection = :collection
+         limit 1) as client_id,
+        (select reason from deleted
+         where user = :user and collection = :collection
+         limit 1) as reason
+    ) as meta
+left outer join
+    applications as apps
+on
+    apps.user = :user
+and
+    apps.collection = :collection
+and
+    apps.last_modified > :since
+order by
+    apps.last_modified
+"""
+
+
 GET_BY_ORIGIN_QUERY = """\
 select
     id, data
@@ -110,6 +160,21 @@ and
 """
 
 
+# the origins placeholders are filled by the caller
+GET_BY_ORIGINS_QUERY = """\
+select
+    id, origin, data
+from
+    applications
+where
+    user = :user
+and
+    collection = :collection
+and
+    origin in (%s)
+"""
+
+
 UPDATE_BY_ORIGIN_QUERY = """\
 update applications
 set
@@ -123,7 +188,6 @@ and
 """
 
 
-# XXX no bulk inserts in sqlite
 PUT_QUERY = """
 insert into applications
     (user, collection, last_modified, data, origin)
@@ -132,6 +196,25 @@ values
 """
 
 
+# upserts rely on the unique (user, collection, origin) index
+UPSERT_MYSQL = """
+insert into applications
+    (user, collection, last_modified, data, origin)
+values
+    (:user, :collection, :last_modified, :data, :origin)
+on duplicate key update
+    data = values(data), last_modified = values(last_modified)
+"""
+
+
+UPSERT_SQLITE = """
+insert or replace into applications
+    (user, collection, last_modified, data, origin)
+values
+    (:user, :collection, :last_modified, :data, :origin)
+"""
+
+
 DEL_QUERY = """
 delete from
     applications
@@ -140,3 +223,38 @@ where
 and
     collection = :collection
 """
+
+
+# keeps the most recently modified row for each (user, collection,
+# origin), the last inserted one if several were modified at the same
+# time. The derived table is needed by MySQL, which cannot select from
+# the table it deletes from.
+DEDUPE_APPLICATIONS = """
+delete from
+    applications
+where
+    id not in (
+        select id from (
+            select
+                max(app.id) as id
+            from
+                applications as app,
+                (
+                    select
+                        user, collection, origin,
+                        max(last_modified) as last_modified
+                    from
+                        applications
+                    group by
+                        user, collection, origin
+                ) as latest
+            where
+                app.user = latest.user
+                and app.collection = latest.collection
+                and app.origin = latest.origin
+                and app.last_modified = latest.last_modified
+            group by
+                app.user, app.collection, app.origin
+        ) as kept
+    )
+"""
@@ -1,9 +1,14 @@
+import os
 import uuid
 import functools
+import threading
+from multiprocessing.pool import ThreadPool
 import simplejson as json
 
 from zope.interface import implements
 
+from pyramid.settings import asbool
+
 from mozsvc.util import round_time
 
 import vep.utils
@@ -12,18 +17,21 @@ import pysauropod
 
 from appsync import logger
 from appsync.cache import Cache, CacheError
+from appsync.metrics import metrics
 from appsync.storage import IAppSyncDatabase
-from appsync.util import urlb64decode
+from appsync.util import urlb64decode, RawJSON
 from appsync.storage import (CollectionDeletedError, EditConflictError,
                              StorageAuthError, ConnectionError, ServerError)
 
 
 def convert_sauropod_errors(func):
-    """Method wrapper to convert sauropod errors into appsync errors."""
+    """Method wrapper to convert sauropod errors into appsync errors, and
+    time the calls."""
     @functools.wraps(func)
     def wrapper(*args, **kwds):
         try:
-            return func(*args, **kwds)
+            with metrics.timer('sauropod.' + func.__name__, part='storage'):
+                return func(*args, **kwds)
         except pysauropod.ConflictError:
             raise EditConflictError
         except pysauropod.AuthenticationError:
@@ -40,6 +48,15 @@ def _key(*args):
     return str(key)
 
 
+# bumped when the format of the cached metadata changes, so the servers
+# running two versions during a deploy don't read each other's values
+_META_VERSION = '2'
+
+
+def _meta_key(user, collection):
+    return _key(user, collection, 'meta', _META_VERSION)
+
+
 class SauropodDatabase(object):
     """AppSync storage engine built on the preliminary Sauropod API.
 
@@ -110,10 +127,22 @@ class SauropodDatabase(object):
             cache_options = {'servers': kwds.pop('cache_servers', '127.0.0.1'),
                              'prefix': kwds.pop('cache_prefix',
                                                 'appsyncsauropod')}
-            self.cache_ttl = kwds.pop('cache_ttl', 300)
+            for option in ('lease_ttl', 'lease_wait', 'stale_ttl'):
+                if 'cache_' + option in kwds:
+                    cache_options[option] = kwds.pop('cache_' + option)
+            self.cache_ttl = int(kwds.pop('cache_ttl', 300))
             self.cache = Cache(**cache_options)
         else:
             self.cache = self.cache_ttl = None
+        # returns the apps as they are stored, instead of parsing them
+        self.raw_json = asbool(kwds.pop('raw_json', False))
+        # number of apps fetched concurrently by get_applications
+        self.fetch_concurrency = int(kwds.pop('fetch_concurrency', 1))
+        # number of threads fetching for all the requests of a process
+        self.fetch_threads = int(kwds.pop('fetch_threads',
+                                          4 * self.fetch_concurrency))
+        self._fetch_pool = self._fetch_pid = None
+        self._fetch_lock = threading.Lock()
         self._store = pysauropod.connect(store_url, appid, **kwds)
         self.authentication = True
 
@@ -154,7 +183,7 @@ class SauropodDatabase(object):
     def _purge_cache(self, user, collection):
         if self.cache is None:
             return
-        cache_key = _key(user, collection, 'meta')
+        cache_key = _meta_key(user, collection)
         try:
             self.cache.delete(cache_key)
         except CacheError:
@@ -165,36 +194,28 @@ class SauropodDatabase(object):
         doc = session.set(key, json.dumps(data), if_match=etag)
 
         if self.cache is not None:
-            cache_key = _key(user, collection, 'meta')
+            cache_key = _meta_key(user, collection)
             try:
-                self.cache.set(cache_key, doc, self.cache_ttl)
+                self.cache.set_computed(cache_key, doc, self.cache_ttl)
             except CacheError:
                 logger.error('Unable to write the metadata in the cache.')
 
     def _get_cached_metadata(self, session, user, collection):
-        # getting the cached value if possible
-        if self.cache is not None:
-            cache_key = _key(user, collection, 'meta')
-            try:
-                cached = self.cache.get(cache_key)
-            except CacheError:
-                logger.error('Unable to read the metadata in the cache.')
-                cached = None
-
-            if cached is not None:
-                return cached
+        def get_metadata():
+            return session.getitem(collection + "::meta")
 
-        # getting the meta document.
-        doc = session.getitem(collection + "::meta")
-
-        # set the cache
-        if self.cache is not None:
-            try:
-                self.cache.set(cache_key, doc, time=self.cache_ttl)
-            except CacheError:
-                logger.error('Was unable to cache the metadata.')
+        if self.cache is None:
+            return get_metadata()
 
-        return doc
+        # getting the cached value if possible. When it expires, a single
+        # client reads the meta document again
+        cache_key = _meta_key(user, collection)
+        try:
+            return self.cache.get_set(cache_key, get_metadata,
+                                      time=self.cache_ttl)
+        except CacheError:
+            logger.error('Unable to read the metadata in the cache.')
+            return get_metadata()
 
     @convert_sauropod_errors
     def get_last_modified(self, user, collection, token):
@@ -277,7 +298,6 @@ class SauropodDatabase(object):
         """Get all applications that have been modified later than 'since'."""
         s = self._resume_session(token)
         since = round_time(since)
-        updates = []
         # Check the collection metadata first.
         # It might be deleted, or last_modified might be too early.
         # In either case, this lets us bail out before doing any hard work.
@@ -285,27 +305,96 @@ class SauropodDatabase(object):
             item = self._get_cached_metadata(s, user, collection)
             meta = json.loads(item.value)
         except KeyError:
-            return updates
+            return []
         if meta.get("deleted", False):
             raise CollectionDeletedError(meta.get("client_id", ""),
                                          meta.get("reason", ""))
+        return self._get_applications(s, collection, meta, since)
+
+    @convert_sauropod_errors
+    def get_collection_snapshot(self, user, collection, since, token):
+        """Returns the uuid, last modified time and apps modified
+        since 'since' of a collection, reading its metadata once.
+
+        Raises a CollectionDeletedError if the collection was deleted.
+        """
+        s = self._resume_session(token)
+        since = round_time(since)
+        try:
+            item = self._get_cached_metadata(s, user, collection)
+            meta = json.loads(item.value)
+        except KeyError:
+            return None, None, []
+        if meta.get("deleted", False):
+            raise CollectionDeletedError(meta.get("client_id", ""),
+                                         meta.get("reason", ""))
+        last_modified = round_time(meta.get("last_modified", 0))
+        return (meta.get("uuid", None), last_modified,
+                self._get_applications(s, collection, meta, since))
+
+    def _get_applications(self, session, collection, meta, since):
         last_modified = round_time(meta.get("last_modified", 0))
         if last_modified < since:
-            return updates
+            return []
         # Read and return all apps with modification time > since.
-        apps = meta.get("apps", [])
-        for (last_modified, appid) in apps:
+        # The index is sorted from the most recent app, but they are
+        # returned from the oldest one.
+        apps = []
+        for (last_modified, appid) in meta.get("apps", []):
             last_modified = round_time(last_modified)
             if last_modified <= since:
                 break
+            apps.append((last_modified, appid))
+        return self._iter_applications(session, collection, reversed(apps))
+
+    def _get_fetch_pool(self):
+        """Returns the pool of the fetching threads of this process.
+
+        It is created by the first request, because the threads of a pool
+        created before the server forks its workers don't follow them.
+        """
+        with self._fetch_lock:
+            if self._fetch_pid != os.getpid():
+                size = max(self.fetch_threads, self.fetch_concurrency)
+                self._fetch_pool = ThreadPool(size)
+                self._fetch_pid = os.getpid()
+            return self._fetch_pool
+
+    def _iter_applications(self, session, collection, apps):
+        """Yields the given apps, reading fetch_concurrency of them at once.
+        """
+        def fetch(app):
+            last_modified, appid = app
             key = "%s::item::%s" % (collection, appid)
             try:
-                app = json.loads(s.get(key))
+                return last_modified, self._get_item(session, key)
             except KeyError:
                 # It has been deleted; ignore it.
-                continue
-            updates.append((last_modified, app))
-        return updates
+                return None
+
+        apps = list(apps)
+        size = self.fetch_concurrency
+        for pos in range(0, len(apps), size):
+            window = apps[pos:pos + size]
+            if len(window) > 1:
+                results = self._get_fetch_pool().map(fetch, window)
+            else:
+                results = [fetch(app) for app in window]
+
+            for result in results:
+                if result is None:
+                    continue
+                last_modified, app = result
+                if self.raw_json:
+                    app = RawJSON(app)
+                else:
+                    app = json.loads(app)
+                yield (last_modified, app)
+
+    @convert_sauropod_errors
+    def _get_item(self, session, key):
+        # the errors raised while iterating need converting too
+        return session.get(key)
 
     @convert_sauropod_errors
     def add_applications(self, user, collection, applications, token):
@@ -334,6 +423,7 @@ class SauropodDatabase(object):
         # already been updated.  If it has been, we get the updated etag
         # so that we can repair the metadata document.
         has_conflict = False
+        updated = set()
         for app in applications:
             appid = app["origin"]
             etag = etags.get(appid, "")
@@ -356,20 +446,20 @@ class SauropodDatabase(object):
                         has_conflict = True
             else:
                 etags[appid] = item.etag
-            # Update the app's modification time in the index list.
-            # We'll re-sort the list once at the end.
-            for i, item in enumerate(apps):
-                if item[1] == appid:
-                    apps[i] = [now, appid]
-                    break
-            else:
-                apps.append([now, appid])
+            updated.add(appid)
         # Update the metadata document.
         # Hopefully no-one else has written it in the meantime.
         # If we get a conflict, we leave all of our modifications in place.
         # The client will just try again later and happily find that all
         # of the keys have already been updated.
-        apps.sort(reverse=True)
+        #
+        # The index is kept sorted from the most recent app.  The updated
+        # apps are merged with the others, which may look more recent than
+        # `now` when the clocks of the servers disagree.  Both lists are
+        # sorted already, so the sort only has to merge them.
+        recent = sorted(([now, appid] for appid in updated), reverse=True)
+        apps = recent + [entry for entry in apps if entry[1] not in updated]
+        apps.sort(key=lambda entry: entry[0], reverse=True)
         meta_data["apps"] = apps
         meta_data["etags"] = etags
         if meta_data.pop("deleted", False):
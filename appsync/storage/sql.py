@@ -1,84 +1,192 @@
+import time
 import traceback
+import uuid
+import hashlib
 
 import simplejson as json
-from sqlalchemy.exc import OperationalError, TimeoutError
-from sqlalchemy import create_engine
+from sqlalchemy.exc import (OperationalError, TimeoutError,
+                            DisconnectionError, SQLAlchemyError)
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base, Column
-from sqlalchemy import Integer, String, Text, BigInteger
+from sqlalchemy import Integer, String, Text, BigInteger, Index
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.sql.expression import text
 
 from zope.interface import implements
 
 import vep
+from vep.verifiers.local import FIFOCache
+
+from pyramid.settings import asbool
 
 from mozsvc.exceptions import BackendError
 from mozsvc.util import round_time, maybe_resolve_name
 
-from appsync.cache import Cache, CacheError
+from appsync.cache import Cache, CacheError, LocalCache
 from appsync import logger
+from appsync.metrics import metrics
 from appsync.storage import queries
 from appsync.storage import (IAppSyncDatabase, CollectionDeletedError,
-                             StorageAuthError, ConnectionError)
-from appsync.util import gen_uuid
+                             StorageAuthError, ConnectionError, ServerError,
+                             MAX_KEY_LENGTH)
+from appsync.util import (gen_uuid, get_assertion_expiry, RawJSON,
+                          TokenSigner)
 
 
 _TABLES = []
 _Base = declarative_base()
 
+# the indexed columns are MAX_KEY_LENGTH characters at most, so they are
+# indexed entirely (InnoDB indexes 767 bytes of a column, 255 characters
+# in utf8) and two different values never share a key
+
 
 class Deleted(_Base):
     __tablename__ = 'deleted'
 
     id = Column(Integer, primary_key=True)
-    user = Column(String(256), nullable=False)
-    collection = Column(String(256), nullable=False)
+    user = Column(String(MAX_KEY_LENGTH), nullable=False)
+    collection = Column(String(MAX_KEY_LENGTH), nullable=False)
     reason = Column(String(256), nullable=False)
     client_id = Column(String(256), nullable=False)
 
 
 deleted = Deleted.__table__
 _TABLES.append(deleted)
+Index('deleted_user_collection', deleted.c.user, deleted.c.collection)
 
 
 class Application(_Base):
     __tablename__ = 'applications'
 
     id = Column(Integer, primary_key=True)
-    user = Column(String(256), nullable=False)
-    collection = Column(String(256), nullable=False)
-    origin = Column(String(256), nullable=False)
+    user = Column(String(MAX_KEY_LENGTH), nullable=False)
+    collection = Column(String(MAX_KEY_LENGTH), nullable=False)
+    origin = Column(String(MAX_KEY_LENGTH), nullable=False)
     last_modified = Column(BigInteger, nullable=False)
     data = Column(Text)
-    ## FIXME: user+collection+origin should/could be unique
 
 applications = Application.__table__
 _TABLES.append(applications)
 
+# polling reads the apps of a collection by modification time, and
+# writes look them up by origin -- which is unique within a collection
+Index('applications_user_collection_lm', applications.c.user,
+      applications.c.collection, applications.c.last_modified)
+Index('applications_user_collection_origin', applications.c.user,
+      applications.c.collection, applications.c.origin, unique=True)
+
 
 class Collection(_Base):
     __tablename__ = 'collections'
     id = Column(Integer, primary_key=True)
     uuid = Column(String(256), nullable=False)
-    user = Column(String(256), nullable=False)
-    collection = Column(String(256), nullable=False)
+    user = Column(String(MAX_KEY_LENGTH), nullable=False)
+    collection = Column(String(MAX_KEY_LENGTH), nullable=False)
 
 
 collections = Collection.__table__
 _TABLES.append(collections)
+Index('collections_user_collection', collections.c.user,
+      collections.c.collection)
 
 
 def _key(*args):
     return ':::'.join(args)
 
 
-def execute_retry(engine, *args, **kwargs):
+def _shrink_columns(engine, inspector, table):
+    """Shrinks the indexed columns that older versions created longer
+    than MAX_KEY_LENGTH characters, so MySQL indexes them entirely.
+    """
+    lengths = dict((column['name'], getattr(column['type'], 'length', None))
+                   for column in inspector.get_columns(table.name))
+    for column in table.columns:
+        length = getattr(column.type, 'length', None)
+        if length != MAX_KEY_LENGTH or lengths.get(column.name) <= length:
+            continue
+        logger.info('Shrinking %s.%s' % (table.name, column.name))
+        engine.execute(text('ALTER TABLE %s MODIFY %s VARCHAR(%d) NOT NULL'
+                            % (table.name, column.name, length)))
+
+
+def _create_index(engine, index):
+    """Creates an index, unless another process created it first.
+
+    Returns True if this call created it.
+    """
     try:
-        return engine.execute(*args, **kwargs)
+        index.create(bind=engine)
+    except SQLAlchemyError:
+        # the servers may be running the migration at the same time
+        inspector = Inspector.from_engine(engine)
+        existing = [other['name'] for other in
+                    inspector.get_indexes(index.table.name)]
+        if index.name not in existing:
+            raise
+        logger.info('Index %r already exists' % index.name)
+        return False
+    return True
+
+
+def create_indexes(engine):
+    """Creates the indexes missing from existing tables.
+
+    Tables created by older versions have no index at all, and they may
+    hold several rows for the same user, collection and origin. Those
+    duplicates are removed -- keeping the most recently modified row,
+    or the last inserted one on a tie -- before the unique index is added.
+    On MySQL, the indexed columns are shrunk to MAX_KEY_LENGTH first.
+
+    This locks the tables while it runs, and the servers of the previous
+    version must be stopped so that they don't insert new duplicates:
+    it is meant to be run once, with the appsync-migrate script.
+
+    Returns the names of the created indexes.
+    """
+    inspector = Inspector.from_engine(engine)
+    created = []
+
+    for table in _TABLES:
+        existing = [index['name'] for index in
+                    inspector.get_indexes(table.name)]
+        if engine.dialect.name == 'mysql':
+            _shrink_columns(engine, inspector, table)
+
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique and table is applications:
+                logger.info('Removing duplicate applications')
+                engine.execute(text(queries.DEDUPE_APPLICATIONS))
+            logger.info('Creating index %r' % index.name)
+            if _create_index(engine, index):
+                created.append(index.name)
+
+    return created
+
+
+def has_unique_origins(engine):
+    """Tells if the applications table has the unique index the upserts
+    rely on.
+    """
+    inspector = Inspector.from_engine(engine)
+    for index in inspector.get_indexes(applications.name):
+        if (index['unique'] and
+            index['column_names'] == ['user', 'collection', 'origin']):
+            return True
+    return False
+
+
+def _retry(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
     except (OperationalError, TimeoutError), exc:
         retry = '2013' in str(exc)
     try:
         if retry:
-            return engine.execute(*args, **kwargs)
+            return func(*args, **kwargs)
         else:
             # re-raise
             raise exc
@@ -88,52 +196,256 @@ def execute_retry(engine, *args, **kwargs):
         raise BackendError(str(exc))
 
 
+def _transaction(engine, func, *args, **kwargs):
+    conn = engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            res = func(conn, *args, **kwargs)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        return res
+    finally:
+        conn.close()
+
+
+def execute_retry(engine, *args, **kwargs):
+    with metrics.timer('sql.execute', part='storage'):
+        return _retry(engine.execute, *args, **kwargs)
+
+
+def transaction_retry(engine, func, *args, **kwargs):
+    """Calls func(connection, *args, **kwargs) within a transaction.
+
+    The transaction is rolled back if func raises an error, and run
+    again once if the connection to the server was lost.
+    """
+    with metrics.timer('sql.transaction', part='storage'):
+        return _retry(_transaction, engine, func, *args, **kwargs)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool reporting how long it takes to check out a connection."""
+
+    def _timed_checkout(self, checkout):
+        start = time.time()
+        try:
+            return checkout(self)
+        except TimeoutError:
+            metrics.incr('sql.pool.timeouts')
+            raise
+        finally:
+            metrics.timing('sql.pool.checkout', time.time() - start)
+
+    def connect(self):
+        return self._timed_checkout(QueuePool.connect)
+
+    def unique_connection(self):
+        return self._timed_checkout(QueuePool.unique_connection)
+
+
+def ping_connection(dbapi_conn, conn_record, conn_proxy):
+    """Checks that a connection is alive when it leaves the pool.
+
+    Dead connections (like the ones MySQL closed after wait_timeout) are
+    replaced by the pool, instead of failing the next query.
+    """
+    try:
+        # some drivers fail as soon as the cursor is created
+        cursor = dbapi_conn.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+    except Exception:
+        metrics.incr('sql.pool.disconnects')
+        raise DisconnectionError()
+
+
+# dialects that can insert or update rows in a single statement
+_UPSERTS = {'mysql': queries.UPSERT_MYSQL,
+            'sqlite': queries.UPSERT_SQLITE}
+
+# stays below the SQLite limit of 999 variables per query
+_MAX_ORIGINS = 500
+
+
+# cached instead of the metadata of a collection that was just written
+_WRITTEN = 'written'
+
+
+def _meta_key(user, collection):
+    return str(':::'.join((user, collection, 'meta')))
+
+
+# the sessions are cached under the token with this prefix
+_TOKEN_PREFIX = 'token:'
+
+
+def _token_key(token):
+    return _TOKEN_PREFIX + token
+
+
+def _is_token(key):
+    return key.startswith(_TOKEN_PREFIX)
+
+
+class KeyCache(FIFOCache):
+    """Keeps the issuers public keys, and the errors met fetching them for
+    `error_timeout` seconds only, so an issuer that was briefly unreachable
+    is tried again soon, without being flooded meanwhile.
+    """
+    def __init__(self, error_timeout=10, **kw):
+        FIFOCache.__init__(self, **kw)
+        self.error_timeout = error_timeout
+
+    def __getitem__(self, hostname):
+        error, key = value = FIFOCache.__getitem__(self, hostname)
+        if error is not None:
+            fetched = self.items_map.get(hostname, (0, None))[0]
+            if fetched + self.error_timeout < time.time():
+                raise KeyError(hostname)
+        return value
+
+
 class SQLDatabase(object):
     implements(IAppSyncDatabase)
 
     def __init__(self, **options):
         verifier = options.pop("verifier", None)
+        # used by the local verifier
+        verifier_refresh = float(options.pop("verifier_refresh", 3600))
+        verifier_error_ttl = float(options.pop("verifier_error_ttl", 10))
+        verifier_urlopen = options.pop("verifier_urlopen", None)
+
         if verifier is None:
             verifier = vep.RemoteVerifier()
+        elif verifier == 'local':
+            # the assertions are checked here, the public keys of the
+            # issuers are fetched every verifier_refresh seconds
+            if verifier_urlopen is not None:
+                verifier_urlopen = maybe_resolve_name(verifier_urlopen)
+            cache = KeyCache(cache_timeout=verifier_refresh,
+                             error_timeout=verifier_error_ttl)
+            verifier = vep.LocalVerifier(urlopen=verifier_urlopen,
+                                         cache=cache)
         else:
             verifier = maybe_resolve_name(verifier)
             if callable(verifier):
                 verifier = verifier()
         self._verifier = verifier
 
-        #sqlkw = {'pool_size': int(options.get('pool_size', 1)),
-        #         'pool_recycle': int(options.get('pool_recycle', 3600)),
-        #         'logging_name': 'appsync'}
-        sqlkw = {}
+        sqluri = options['sqluri']
+        sqlkw = {'logging_name': 'appsync'}
+
+        # SQLite does not use a QueuePool
+        if not sqluri.startswith('sqlite'):
+            sqlkw['poolclass'] = TimedQueuePool
+            sqlkw['pool_recycle'] = int(options.get('pool_recycle', 3600))
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                if option in options:
+                    sqlkw[option] = int(options[option])
+
+        self.engine = create_engine(sqluri, **sqlkw)
+        if asbool(options.get('pool_pre_ping', False)):
+            event.listen(self.engine, 'checkout', ping_connection)
 
-        self.engine = create_engine(options['sqluri'], **sqlkw)
         for table in _TABLES:
             table.metadata.bind = self.engine
             if options.get('create_tables', True):
                 table.create(checkfirst=True)
 
+        # tables created by previous versions need their indexes, which
+        # is better done once with appsync-migrate than by every worker
+        if asbool(options.get('create_indexes', False)):
+            create_indexes(self.engine)
+
+        # the upserts need the unique index, that tables created by
+        # previous versions lack until they are migrated
+        self._upsert = _UPSERTS.get(self.engine.dialect.name)
+        if self._upsert is not None and not has_unique_origins(self.engine):
+            logger.error('The applications table has no unique index on '
+                         'the origins, the updates will be slower')
+            self._upsert = None
+
+        # returns the apps as they are stored, instead of parsing them
+        self.raw_json = asbool(options.get('raw_json', False))
+
+        # number of apps read at once by get_applications
+        self.yield_per = int(options.get('yield_per', 100))
+
         self.session_ttl = int(options.get('session_ttl', '300'))
         cache_options = {'servers': options.get('cache_servers', '127.0.0.1'),
                          'prefix': options.get('cache_prefix', 'appsyncsql')}
 
         self.cache = Cache(**cache_options)
+
+        # the uuid, last modified time and deleted state of the
+        # collections can be kept in the cache
+        self.cache_activated = asbool(options.get('cache_activated', False))
+        self.cache_ttl = int(options.get('cache_ttl', 300))
+        # after a write, the metadata are not cached for a few seconds,
+        # so the readers that read them before can't cache old ones
+        # (0 would keep the guard forever in memcached)
+        self.cache_write_guard = max(int(options.get('cache_write_guard',
+                                                     2)), 1)
+
+        # the tokens recently checked can be kept in memory for a few
+        # seconds, saving a memcached lookup on most requests. The
+        # metadata are changed by the other processes, so they are
+        # always read from memcached
+        local_cache_size = int(options.get('local_cache_size', 0))
+        if local_cache_size > 0:
+            local_cache_ttl = min(float(options.get('local_cache_ttl', 5)),
+                                  self.session_ttl)
+            self.cache = LocalCache(self.cache, local_cache_size,
+                                    local_cache_ttl, keep=_is_token)
+
+        # the verified assertions are cached until they expire
+        self.cache_assertions = asbool(options.get('cache_assertions', False))
+
+        # when secrets are provided, the tokens are signed and checked
+        # without any memcached lookup
+        token_secrets = options.get('token_secrets')
+        if token_secrets:
+            self.token_signer = TokenSigner(token_secrets, self.session_ttl)
+        else:
+            self.token_signer = None
         self.authentication = True
 
     def set_authentication(self, state):
         self.authentication = state
 
+    def _load(self, data):
+        if self.raw_json:
+            return RawJSON(data)
+        return json.loads(data)
+
     def _execute(self, expr, *args, **kw):
         return execute_retry(self.engine, text(expr), *args, **kw)
 
+    def _stream(self, expr, *args, **kw):
+        # uses a server-side cursor if the driver supports it, which is
+        # only psycopg2 with SQLAlchemy 0.7: the MySQL drivers read the
+        # whole result at once, and max_applications bounds it instead
+        expr = text(expr).execution_options(stream_results=True)
+        return execute_retry(self.engine, expr, *args, **kw)
+
     def delete(self, user, collection, client_id, reason, token):
         self._check_token(token)
         self._execute(queries.DEL_QUERY, user=user, collection=collection)
         self._execute(queries.ADD_DEL, user=user, collection=collection,
                       reason=reason, client_id=client_id)
         self._execute(queries.DEL_UUID, user=user, collection=collection)
+        self._refresh_metadata(user, collection)
 
     def get_uuid(self, user, collection, token):
-        self._check_token(token)
+        cached = self._check_token_and_metadata(user, collection, token)
+        if self.cache_activated:
+            return self._get_metadata(user, collection, cached)['uuid']
+
         res = self._execute(queries.GET_UUID, user=user, collection=collection)
         res = res.fetchone()
         if res is None:
@@ -141,22 +453,30 @@ class SQLDatabase(object):
         return res.uuid
 
     def get_applications(self, user, collection, since, token):
-        self._check_token(token)
-
-        # is this a deleted collection ?
-        res = self._execute(queries.IS_DEL, user=user, collection=collection)
-        deleted = res.fetchone()
-        if deleted is not None:
-            raise CollectionDeletedError(deleted.client_id, deleted.reason)
+        cached = self._check_token_and_metadata(user, collection, token)
 
-        # get the last modified
-        res = self._execute(queries.LAST_MODIFIED, user=user,
-                            collection=collection)
-        res = res.fetchone()
-        if res in (None, (None,)):
-            last_modified = None
+        if self.cache_activated:
+            meta = self._get_metadata(user, collection, cached)
+            if meta['deleted'] is not None:
+                raise CollectionDeletedError(*meta['deleted'])
+            last_modified = meta['last_modified']
         else:
-            last_modified = res.last_modified
+            # is this a deleted collection ?
+            res = self._execute(queries.IS_DEL, user=user,
+                                collection=collection)
+            deleted = res.fetchone()
+            if deleted is not None:
+                raise CollectionDeletedError(deleted.client_id,
+                                             deleted.reason)
+
+            # get the last modified
+            res = self._execute(queries.LAST_MODIFIED, user=user,
+                                collection=collection)
+            res = res.fetchone()
+            if res in (None, (None,)):
+                last_modified = None
+            else:
+                last_modified = res.last_modified
 
         # using hundredth of seconds
         since = int(round_time(since) * 100)
@@ -165,60 +485,155 @@ class SQLDatabase(object):
         if last_modified < since:
             return []
 
-        apps = self._execute(queries.GET_QUERY, user=user,
-                             collection=collection, since=since)
+        apps = self._stream(queries.GET_QUERY, user=user,
+                            collection=collection, since=since)
+        return self._iter_applications(apps)
 
-        # XXX dumb: serialize/unserialize round trip for nothing
-        return [(round_time(app.last_modified / 100.),
-                 json.loads(app.data)) for app in apps]
+    def get_collection_snapshot(self, user, collection, since, token):
+        """Returns the uuid, last modified time and apps modified
+        since 'since' of a collection, using a single query.
+
+        Raises a CollectionDeletedError if the collection was deleted.
+        """
+        cached = self._check_token_and_metadata(user, collection, token)
+        since = int(round_time(since) * 100)
+
+        if self.cache_activated:
+            meta = self._get_metadata(user, collection, cached)
+            if meta['deleted'] is not None:
+                raise CollectionDeletedError(*meta['deleted'])
+
+            # nothing changed since then, no need to ask SQL
+            last_modified = meta['last_modified']
+            if last_modified is None:
+                return meta['uuid'], None, []
+            if last_modified <= since:
+                return (meta['uuid'], round_time(last_modified / 100.),
+                        [])
+
+        res = self._stream(queries.GET_SNAPSHOT, user=user,
+                           collection=collection, since=since)
+        try:
+            meta = self._fetch(res.fetchone)
+        except ServerError:
+            res.close()
+            raise
+        if meta.client_id is not None:
+            res.close()
+            raise CollectionDeletedError(meta.client_id, meta.reason)
+
+        if meta.collection_modified is None:
+            last_modified = None
+        else:
+            last_modified = round_time(meta.collection_modified / 100.)
+
+        # the first row holds the first app, if any
+        return meta.uuid, last_modified, self._iter_applications(res, meta)
+
+    def _iter_applications(self, res, first=None):
+        """Yields the apps of a query result, fetching yield_per rows
+        at a time.
+
+        The result holds its connection until all the apps are read or
+        the generator is closed. With stream_applications, that lasts as
+        long as the client takes to download the response, so the pool
+        must be large enough for the slow clients too. A ServerError
+        raised then can't change the status of the response anymore.
+        """
+        try:
+            if first is not None:
+                rows = [first]
+            else:
+                rows = self._fetch(res.fetchmany, self.yield_per)
+
+            while rows:
+                for app in rows:
+                    if app.data is None:
+                        # no app in that collection
+                        continue
+                    yield (round_time(app.last_modified / 100.),
+                           self._load(app.data))
+                rows = self._fetch(res.fetchmany, self.yield_per)
+        finally:
+            res.close()
+
+    def _fetch(self, fetch, *args):
+        # the errors of the queries run lazily are not retried
+        try:
+            return fetch(*args)
+        except SQLAlchemyError, exc:
+            logger.error(traceback.format_exc())
+            raise ServerError(str(exc))
 
     def add_applications(self, user, collection, applications, token):
         self._check_token(token)
-        res = self._execute(queries.IS_DEL, user=user, collection=collection)
-        deleted = res.fetchone()
-        res.close()
-        if deleted is not None:
-            self._execute(queries.REMOVE_DEL, user=user, collection=collection)
+        transaction_retry(self.engine, self._add_applications, user,
+                          collection, applications)
+        self._refresh_metadata(user, collection)
 
+    def _add_applications(self, conn, user, collection, applications):
         now = int(round_time() * 100)
+        params = {'user': user, 'collection': collection}
+
+        # the collection is not deleted anymore, if it was
+        conn.execute(text(queries.REMOVE_DEL), **params)
 
         # let's see if we have an uuid
-        res = self._execute(queries.GET_UUID, user=user,
-                            collection=collection)
-        res = res.fetchone()
+        res = conn.execute(text(queries.GET_UUID), **params).fetchone()
         if res is None:
             # we need to create one
-            uuid = '%s-%s' % (now, collection)
-            self._execute(queries.ADD_UUID, user=user,
-                          collection=collection, uuid=uuid)
-        else:
-            uuid = res.uuid
+            conn.execute(text(queries.ADD_UUID), uuid=uuid.uuid4().hex,
+                         **params)
+
+        # one row per origin, the last update wins
+        data = dict((app['origin'], json.dumps(app)) for app in applications)
+        if not data:
+            return
+
+        rows = [dict(params, origin=origin, data=value, last_modified=now)
+                for origin, value in data.items()]
+
+        if self._upsert is not None:
+            conn.execute(text(self._upsert), rows)
+            return
+
+        # looking up all the stored origins at once
+        existing = {}
+        origins = data.keys()
+        for pos in range(0, len(origins), _MAX_ORIGINS):
+            chunk = origins[pos:pos + _MAX_ORIGINS]
+            binds = dict(('origin%d' % index, origin)
+                         for index, origin in enumerate(chunk))
+            query = queries.GET_BY_ORIGINS_QUERY % ', '.join(
+                        ':' + name for name in sorted(binds))
+            binds.update(params)
+            for res in conn.execute(text(query), **binds):
+                existing[res.origin] = res
 
-        # the *real* storage will do bulk inserts of course
-        for app in applications:
-            origin = app['origin']
-            res = self._execute(queries.GET_BY_ORIGIN_QUERY, user=user,
-                                collection=collection, origin=origin)
-            res = res.fetchone()
-            if res is None:
-                self._execute(queries.PUT_QUERY, user=user,
-                              collection=collection,
-                              last_modified=now, data=json.dumps(app),
-                              origin=app['origin'])
-            else:
                 ## FIXME: for debugging
-                if res.data == json.dumps(app):
+                if res.data == data[res.origin]:
                     ## This is a logic error on the client:
                     logger.error(('Bad attempt to update an application '
-                                  ' to overwrite itself: %r') % app['origin'])
+                                  ' to overwrite itself: %r') % res.origin)
+
+        added = [row for row in rows if row['origin'] not in existing]
+        if added:
+            conn.execute(text(queries.PUT_QUERY), added)
 
-                self._execute(queries.UPDATE_BY_ORIGIN_QUERY, user=user,
-                              collection=collection,
-                              id=res.id, data=json.dumps(app),
-                              last_modified=now)
+        updated = [dict(row, id=existing[row['origin']].id) for row in rows
+                   if row['origin'] in existing]
+        if updated:
+            conn.execute(text(queries.UPDATE_BY_ORIGIN_QUERY), updated)
 
     def get_last_modified(self, user, collection, token):
-        self._check_token(token)
+        cached = self._check_token_and_metadata(user, collection, token)
+        if self.cache_activated:
+            meta = self._get_metadata(user, collection, cached)
+            last_modified = meta['last_modified']
+            if last_modified is None:
+                return None
+            return round_time(last_modified / 100.)
+
         res = self._execute(queries.LAST_MODIFIED, user=user,
                             collection=collection)
         res = res.fetchone()
@@ -227,38 +642,167 @@ class SQLDatabase(object):
         # last modified is a timestamp * 100
         return round_time(res.last_modified / 100.)
 
+    #
+    # collections metadata cache
+    #
+    def _read_metadata(self, user, collection):
+        res = self._execute(queries.GET_METADATA, user=user,
+                            collection=collection).fetchone()
+        meta = {'uuid': res.uuid, 'last_modified': res.last_modified,
+                'deleted': None}
+        if res.client_id is not None:
+            meta['deleted'] = res.client_id, res.reason
+        return meta
+
+    def _cache_metadata(self, key, meta):
+        # does not replace the guard set by a write
+        try:
+            self.cache.add(key, meta, time=self.cache_ttl)
+        except CacheError:
+            logger.error('Unable to write the metadata in the cache.')
+
+    def _check_token_and_metadata(self, user, collection, token):
+        """Checks the token and, when the metadata are cached, reads them
+        in the same round trip.
+        """
+        if not self.cache_activated:
+            self._check_token(token)
+            return {}
+        return self._check_token(token, [_meta_key(user, collection)])
+
+    def _get_metadata(self, user, collection, cached):
+        """Returns the uuid, last_modified and deleted state of a
+        collection, from the values read by _check_token_and_metadata
+        if possible.
+        """
+        key = _meta_key(user, collection)
+        meta = cached.get(key)
+        if meta is None or meta == _WRITTEN:
+            meta = self._read_metadata(user, collection)
+            self._cache_metadata(key, meta)
+        return meta
+
+    def _refresh_metadata(self, user, collection):
+        """Drops the cached metadata of a collection that was just written.
+
+        A guard is cached instead for `cache_write_guard` seconds, so the
+        readers and writers that read the metadata before this write can't
+        cache them anymore.
+        """
+        if not self.cache_activated:
+            return
+        try:
+            self.cache.set(_meta_key(user, collection), _WRITTEN,
+                           time=self.cache_write_guard)
+        except CacheError:
+            logger.error('Unable to write the metadata in the cache.')
+
     def verify(self, assertion, audience):
         """Authenticate then return a token"""
         if not self.authentication:
             raise NotImplementedError('authentication not activated')
 
         try:
-            email = self._verifier.verify(assertion, audience)["email"]
+            email = self._verify_assertion(assertion, audience)["email"]
         except (ValueError, vep.TrustError), e:
             raise StorageAuthError(str(e))
+        except vep.ConnectionError, e:
+            # the verifier or an issuer is unreachable, it's not the
+            # assertion's fault
+            logger.error('Unable to verify the assertion: %s' % e)
+            raise ConnectionError()
+
+        if self.token_signer is not None:
+            return email, self.token_signer.sign(email, audience)
 
         # create the token and create a session with it
         token = gen_uuid(email, audience)
 
-        # if this generates a cache error, we cannot store the token
+        # if this generates a cache error, we cannot store the token.
+        # The expiry is kept along, so the token does not live longer
+        # in the memory of the processes than in memcached
+        expires = time.time() + self.session_ttl
         try:
-            self.cache.set(token, (email, audience), time=self.session_ttl)
+            self.cache.set(_token_key(token), (email, audience, expires),
+                           time=self.session_ttl)
         except CacheError:
             raise ConnectionError()
 
         return email, token
 
-    def _check_token(self, token):
-        if not self.authentication:
-            # bypass authentication
-            return
+    def _verify_assertion(self, assertion, audience):
+        """Verifies the assertion, unless it was already verified."""
+        key = None
+        if self.cache_assertions:
+            digest = hashlib.sha256('%s\n%s' % (assertion, audience))
+            key = 'assertion:' + digest.hexdigest()
+            try:
+                res = self.cache.get(key)
+            except CacheError:
+                logger.error('Unable to read the verified assertions')
+                res = None
+
+            if res is not None:
+                metrics.incr('verifier.cache.hits')
+                return res
+            metrics.incr('verifier.cache.misses')
+
+        with metrics.timer('verifier.verify', part='verifier'):
+            res = self._verifier.verify(assertion, audience)
+
+        if key is not None:
+            try:
+                ttl = int(get_assertion_expiry(assertion) - time.time())
+            except ValueError:
+                ttl = 0
+
+            if ttl > 0:
+                try:
+                    self.cache.set(key, res, time=ttl)
+                except CacheError:
+                    logger.error('Unable to cache a verified assertion')
+
+        return res
+
+    def check_token(self, token):
+        """Raises a StorageAuthError if the token is not valid."""
+        self._check_token(token)
+
+    def _check_token(self, token, prefetch=()):
+        """Checks the token.
+
+        The `prefetch` keys are read from the cache in the same round
+        trip, and returned in a dict.
+        """
+        keys = list(prefetch)
+        check = (self.authentication and
+                 (self.token_signer is None or
+                  self.token_signer.verify(token) is None))
+        if check:
+            if not token:
+                raise StorageAuthError()
+            # previous versions cached the sessions under the bare token
+            keys.extend((_token_key(token), token))
+        if not keys:
+            return {}
 
         # XXX do we want to check that the user owns that path ?
         try:
-            res = self.cache.get(token)
+            res = self.cache.get_multi(keys)
         except CacheError:
-            # the cache was unreachable so no auth possible
-            raise StorageAuthError()
-
-        if res is None:
-            raise StorageAuthError()
+            if check:
+                # the cache was unreachable so no auth possible
+                raise StorageAuthError()
+            logger.error('Unable to read the metadata in the cache.')
+            return {}
+
+        if check:
+            session = res.pop(_token_key(token), None)
+            legacy = res.pop(token, None)
+            if session is None:
+                session = legacy
+            # the tokens created by previous versions have no expiry
+            if session is None or (len(session) > 2 and
+                                   session[2] < time.time()):
+                raise StorageAuthError()
+        return res
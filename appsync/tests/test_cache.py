@@ -1,11 +1,16 @@
 import os
+import threading
+import time
+import unittest
+from contextlib import contextmanager
 
 from zope.interface.registry import ComponentLookupError
 
 import vep
 
-from appsync.tests.test_server import TestSyncApp
-from appsync.cache import IAppCache, CacheError
+from appsync.tests.test_server import TestSyncApp, FakeCache
+from appsync.cache import IAppCache, CacheError, Cache, LocalCache
+from appsync.metrics import metrics
 
 
 _INI = os.path.join(os.path.dirname(__file__), 'tests_cache.ini')
@@ -46,6 +51,218 @@ class TestCache(TestSyncApp):
 
         # getting the collection 'blah'
         res = self.app.get('/collections/t@m.com/blah',
-                            extra_environ=extra)
+                           extra_environ=extra)
 
         self.assertEquals(res.headers['X-Sync-Poll'], '120')
+
+    def test_multi(self):
+        registry = self.app.app.app.app.registry
+
+        try:
+            cache = registry.getUtility(IAppCache)
+            cache.get('test')
+        except (ComponentLookupError, CacheError):
+            return   # no cache, or memcached not running
+
+        cache.set_multi({'one': 1, 'two': 2})
+        self.assertEqual(cache.get('one'), 1)
+        self.assertEqual(cache.get_multi(['one', 'two', 'three']),
+                         {'one': 1, 'two': 2})
+        cache.delete_multi(['one', 'two'])
+        self.assertEqual(cache.get_multi(['one', 'two']), {})
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.remote = FakeCache()
+        self.cache = LocalCache(self.remote, size=2, ttl=.1)
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_hits(self):
+        self.remote['token'] = ('t@m.com', 'audience')
+        for i in range(3):
+            self.assertEqual(self.cache.get('token'), ('t@m.com', 'audience'))
+        self.assertEqual(self.cache.get('unknown'), None)
+
+        # the remote cache was read for the first get only
+        del self.remote['token']
+        self.assertEqual(self.cache.get('token'), ('t@m.com', 'audience'))
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cache.local.hits'], 3)
+        self.assertEqual(counters['cache.local.misses'], 2)
+
+    def test_ttl(self):
+        self.cache.set('short', 1, time=.01)
+        self.cache.set('long', 2)
+        self.assertEqual(self.remote, {'short': 1, 'long': 2})
+
+        time.sleep(.02)
+        self.remote.clear()
+        self.assertEqual(self.cache.get('short'), None)
+        self.assertEqual(self.cache.get('long'), 2)
+
+        time.sleep(.1)
+        self.assertEqual(self.cache.get('long'), None)
+
+    def test_size(self):
+        for key in ('one', 'two', 'three'):
+            self.cache.set(key, key)
+        self.remote.clear()
+
+        # the least recently used key was dropped
+        self.assertEqual(self.cache.get('one'), None)
+        self.assertEqual(self.cache.get('two'), 'two')
+        self.assertEqual(self.cache.get('three'), 'three')
+
+    def test_multi(self):
+        self.remote.update({'one': 1, 'two': 2})
+        self.assertEqual(self.cache.get('one'), 1)
+        self.assertEqual(self.cache.get_multi(['one', 'two', 'three']),
+                         {'one': 1, 'two': 2})
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cache.local.hits'], 1)
+        self.assertEqual(counters['cache.local.misses'], 3)
+
+        self.cache.set_multi({'three': 3}, time=.01)
+        self.assertEqual(self.remote['three'], 3)
+        self.cache.delete_multi(['one', 'two'])
+        self.assertEqual(self.remote, {'three': 3})
+        time.sleep(.02)
+        self.assertEqual(self.cache.get_multi(['one', 'three']), {'three': 3})
+
+    def test_keep(self):
+        cache = LocalCache(self.remote, keep=lambda key: key != 'meta')
+        cache.set_multi({'token': 1, 'meta': 2})
+        self.remote.clear()
+        self.assertEqual(cache.get_multi(['token', 'meta']), {'token': 1})
+        self.assertEqual(cache.get('meta'), None)
+        self.assertEqual(cache._items.keys(), ['token'])
+
+    def test_delete(self):
+        self.cache.set('token', 1)
+        self.cache.delete('token')
+        self.assertEqual(self.cache.get('token'), None)
+
+
+class FakeClient(dict):
+    """Stand-in for a pylibmc client."""
+
+    def set(self, key, value, time=0):
+        self[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if key in self:
+            return False
+        return self.set(key, value, time)
+
+    def delete(self, key):
+        return self.pop(key, None) is not None
+
+
+class FakePool(object):
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def reserve(self):
+        yield self.client
+
+
+class TestGetSet(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.cache = Cache(servers='127.0.0.1', prefix='test',
+                           lease_wait='0.2')
+        self.cache.pool = FakePool(FakeClient())
+        self.calls = []
+
+    def tearDown(self):
+        metrics.reset()
+
+    def _compute(self):
+        self.calls.append(1)
+        return len(self.calls)
+
+    def test_get_set(self):
+        for i in range(3):
+            self.assertEqual(self.cache.get_set('key', self._compute,
+                                                time=.05), 1)
+        self.assertEqual(len(self.calls), 1)
+        # the lease was released
+        self.assertEqual(self.cache.pool.client.keys(), ['test:key'])
+
+        # expired: the first client computes it again
+        time.sleep(.06)
+        self.assertEqual(self.cache.get_set('key', self._compute), 2)
+
+    def test_stale(self):
+        self.cache.get_set('key', self._compute, time=.05)
+        time.sleep(.06)
+
+        # someone else holds the lease, the expired value is used
+        self.cache.pool.client.add('test:lease:key', 1)
+        self.assertEqual(self.cache.get_set('key', self._compute), 1)
+        self.assertEqual(len(self.calls), 1)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['cache.get_set.stale'], 1)
+
+    def test_wait(self):
+        self.cache.pool.client.add('test:lease:key', 1)
+
+        # someone else is computing the missing value
+        def compute():
+            time.sleep(.1)
+            self.cache.set_computed('key', 'computed')
+
+        threading.Thread(target=compute).start()
+        self.assertEqual(self.cache.get_set('key', self._compute),
+                         'computed')
+        self.assertEqual(self.calls, [])
+
+        # it takes too long, we don't wait anymore
+        self.cache.pool.client.add('test:lease:other', 1)
+        self.assertEqual(self.cache.get_set('other', self._compute), 1)
+        self.assertEqual(metrics.snapshot()['counters']['cache.get_set.waits'],
+                         2)
+
+    def test_format(self):
+        # plain tagged tuples, readable by any version of the code
+        self.cache.get_set('key', self._compute, time=10)
+        tag, value, expires = self.cache.pool.client['test:key']
+        self.assertEqual(tag, 'appsync:entry')
+        self.assertEqual(value, 1)
+        self.assertTrue(time.time() < expires <= time.time() + 10)
+
+        # the values of another format are computed again
+        self.cache.pool.client['test:other'] = 'something'
+        self.assertEqual(self.cache.get_set('other', self._compute), 2)
+        self.cache.pool.client['test:pair'] = ('some', 'thing')
+        self.assertEqual(self.cache.get_set('pair', self._compute), 3)
+
+    def test_lease_errors(self):
+        # the computed value is returned even if the lease is kept
+        def release(key):
+            raise CacheError('Boom')
+
+        self.cache._release_lease = release
+        self.assertEqual(self.cache.get_set('key', self._compute), 1)
+        self.assertEqual(self.cache.get_set('key', self._compute), 1)
+
+    def test_local_stale(self):
+        local = LocalCache(self.cache, ttl=10)
+        self.assertEqual(local.get_set('key', self._compute, time=.05), 1)
+        time.sleep(.06)
+
+        # the stale value is served, but not kept in memory
+        self.cache.pool.client.add('test:lease:key', 1)
+        self.assertEqual(local.get_set('key', self._compute, time=.05), 1)
+        self.assertEqual(local._items.keys(), [])
+        self.cache.pool.client.delete('test:lease:key')
+        self.assertEqual(local.get_set('key', self._compute, time=.05), 2)
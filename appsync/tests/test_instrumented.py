@@ -0,0 +1,87 @@
+import os
+import time
+import unittest
+
+from appsync.metrics import metrics
+from appsync.storage import CollectionDeletedError
+from appsync.storage.instrumented import InstrumentedDatabase
+
+
+_DB = '/tmp/appsync-test-instrumented.db'
+
+
+class TestInstrumented(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        if os.path.exists(_DB):
+            os.remove(_DB)
+
+    def _get_db(self, instrumented='true'):
+        db = InstrumentedDatabase(inner='appsync.storage.sql.SQLDatabase',
+                                  **{'inner.sqluri': 'sqlite:///' + _DB,
+                                     'instrumented': instrumented})
+        db.set_authentication(False)
+        return db
+
+    def test_metrics(self):
+        db = self._get_db()
+        apps = [{'origin': 'app%d' % i} for i in range(3)]
+        db.add_applications('tarek', 'apps', apps, None)
+        self.assertEqual(len(list(db.get_applications('tarek', 'apps', 0,
+                                                      None))), 3)
+        __, __, apps = db.get_collection_snapshot('tarek', 'apps', 0, None)
+        self.assertEqual(len(list(apps)), 3)
+
+        db.delete('tarek', 'apps', 'client', 'reason', None)
+        self.assertRaises(CollectionDeletedError, db.get_applications,
+                          'tarek', 'apps', 0, None)
+
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(counters['storage.add_applications.apps'], 3)
+        self.assertEqual(counters['storage.get_applications.apps'], 3)
+        self.assertEqual(counters['storage.get_collection_snapshot.apps'], 3)
+        self.assertEqual(counters['storage.get_applications.errors.'
+                                  'CollectionDeletedError'], 1)
+        timers = snapshot['timers']
+        self.assertEqual(timers['storage.get_applications']['count'], 2)
+        self.assertEqual(timers['storage.delete']['count'], 1)
+
+        # the other attributes are the inner backend's ones
+        self.assertEqual(db.yield_per, db._inner.yield_per)
+
+    def test_lazy_errors(self):
+        db = self._get_db()
+
+        def get_applications(*args, **kw):
+            yield 1, {'origin': 'app1'}
+            time.sleep(.05)
+            raise ValueError('Boom')
+
+        db._inner.get_applications = get_applications
+        apps = db.get_applications('tarek', 'apps', 0, None)
+        # nothing is recorded until the apps are read
+        self.assertFalse('storage.get_applications' in
+                         metrics.snapshot()['timers'])
+        self.assertRaises(ValueError, list, apps)
+
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(counters['storage.get_applications.apps'], 1)
+        self.assertEqual(counters['storage.get_applications.errors.'
+                                  'ValueError'], 1)
+        timer = snapshot['timers']['storage.get_applications']
+        self.assertEqual(timer['count'], 1)
+        self.assertTrue(timer['max'] >= .05)
+
+    def test_disabled(self):
+        db = self._get_db(instrumented='false')
+        self.assertEqual(db.get_applications, db._inner.get_applications)
+        self.assertEqual(db.get_collection_snapshot,
+                         db._inner.get_collection_snapshot)
+        db.add_applications('tarek', 'apps', [{'origin': 'app1'}], None)
+        self.assertEqual(metrics.snapshot()['counters'], {})
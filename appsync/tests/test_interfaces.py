@@ -18,3 +18,7 @@ class TestDatabaseInterfaces(unittest.TestCase):
             pass
         else:
             verifyClass(IAppSyncDatabase, SauropodDatabase)
+
+    def test_instrumented_backend(self):
+        from appsync.storage.instrumented import InstrumentedDatabase
+        verifyClass(IAppSyncDatabase, InstrumentedDatabase)
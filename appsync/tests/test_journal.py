@@ -0,0 +1,73 @@
+import os
+import unittest
+
+from appsync.storage.journal import Journal
+
+
+_JOURNAL = '/tmp/appsync-test.journal'
+
+
+class TestJournal(unittest.TestCase):
+
+    def tearDown(self):
+        for path in (_JOURNAL, _JOURNAL + '.offset', _JOURNAL + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_replay(self):
+        journal = Journal(_JOURNAL, fsync_every=2)
+        for i in range(3):
+            journal.append({'write': i})
+        journal.sync()
+
+        # the replay stops at the first error
+        replayed = []
+
+        def apply(record):
+            if record['write'] == 2:
+                raise ValueError('Boom')
+            replayed.append(record['write'])
+
+        self.assertEqual(journal.replay(apply), 2)
+        self.assertEqual(replayed, [0, 1])
+        self.assertTrue(journal.pending() > 0)
+        journal.close()
+
+        # the replayed writes are not replayed again after a restart
+        journal = Journal(_JOURNAL)
+        self.assertEqual(journal.replay(replayed.append), 1)
+        self.assertEqual(replayed, [0, 1, {'write': 2}])
+        self.assertEqual(journal.pending(), 0)
+        self.assertEqual(os.path.getsize(_JOURNAL), 0)
+        journal.close()
+
+    def test_partial_write(self):
+        with open(_JOURNAL, 'w') as f:
+            # longer than the chunks read to find the last line
+            f.write('{"write": 0}\n{"write": "%s' % ('x' * 100000))
+
+        journal = Journal(_JOURNAL)
+        journal.append({'write': 1})
+        replayed = []
+        self.assertEqual(journal.replay(replayed.append), 2)
+        self.assertEqual(replayed, [{'write': 0}, {'write': 1}])
+        journal.close()
+
+    def test_shared(self):
+        # the workers of a server share the journal
+        journals = [Journal(_JOURNAL), Journal(_JOURNAL)]
+        for i in range(4):
+            journals[i % 2].append({'write': i})
+
+        replayed = []
+        self.assertEqual(journals[1].replay(replayed.append), 4)
+        self.assertEqual(replayed, [{'write': i} for i in range(4)])
+        for journal in journals:
+            self.assertEqual(journal.pending(), 0)
+
+        # the journal starts over for everyone
+        journals[0].append({'write': 4})
+        self.assertEqual(journals[1].replay(replayed.append), 1)
+        self.assertEqual(replayed[-1], {'write': 4})
+        for journal in journals:
+            journal.close()
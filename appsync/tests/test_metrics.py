@@ -0,0 +1,30 @@
+import unittest
+
+from appsync.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.incr('calls')
+        metrics.incr('calls', 2)
+        metrics.gauge('size', 12)
+        metrics.gauge('depth', lambda: 3)
+        for duration in (0.0005, 0.002, 0.02, 0.02, 20):
+            metrics.timing('call', duration)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'calls': 3})
+        self.assertEqual(snapshot['gauges'], {'size': 12, 'depth': 3})
+
+        timer = snapshot['timers']['call']
+        self.assertEqual(timer['count'], 5)
+        self.assertEqual(timer['max'], 20000)
+        self.assertEqual(timer['p50'], 25)
+        self.assertEqual(timer['p99'], 20000)
+        self.assertEqual(timer['buckets']['1'], 1)
+        self.assertEqual(timer['buckets']['inf'], 1)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['timers'], {})
@@ -1,11 +1,17 @@
 import os
 import time
+import json
 
+from appsync.metrics import metrics
 from appsync.storage import IAppSyncDatabase, StorageAuthError
-from appsync.tests.test_server import TestSyncApp, vep
+from appsync.storage.mirrored import MirroredDatabase
+from appsync.storage.sql import _token_key
+from appsync.tests.test_server import TestSyncApp, FakeCache, vep
 
 
 _INI = os.path.join(os.path.dirname(__file__), 'test_mirror.ini')
+_DBS = ['/tmp/appsync-test-mirror-rw.db', '/tmp/appsync-test-mirror-w.db']
+_JOURNAL = '/tmp/appsync-test-mirror.journal'
 
 
 class TestMirror(TestSyncApp):
@@ -60,3 +66,243 @@ class TestMirror(TestSyncApp):
         # which would fail on the master
         self.assertRaises(StorageAuthError, master.add_applications,
                           't@m.com', 'blah', apps, 'faketoken')
+
+    def _mirrored(self, **options):
+        for name, db in zip(('readwrite', 'write'), _DBS):
+            options[name] = 'appsync.storage.sql.SQLDatabase'
+            options[name + '.sqluri'] = 'sqlite:///' + db
+        metrics.reset()
+        storage = MirroredDatabase(**options)
+        storage._readwrite.cache = FakeCache()
+        storage._readwrite.cache[_token_key('token')] = ('t@m.com',
+                                                         'audience')
+        return storage
+
+    def _clear(self):
+        metrics.reset()
+        for path in _DBS + [_JOURNAL, _JOURNAL + '.offset',
+                            _JOURNAL + '.lock']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_async_writes(self):
+        storage = self._mirrored(mirror_mode='async', retry_delay='0',
+                                 write_retries='1')
+
+        # a slow mirror, failing once
+        calls = []
+        write = storage._write.add_applications
+
+        def add_applications(*args):
+            calls.append(args)
+            time.sleep(.2)
+            if len(calls) == 1:
+                raise ValueError('Boom')
+            return write(*args)
+
+        storage._write.add_applications = add_applications
+        try:
+            start = time.time()
+            storage.add_applications('t@m.com', 'blah', [{'origin': 'app1'}],
+                                     'token')
+            # the client does not wait for the mirror
+            self.assertTrue(time.time() - start < .2)
+
+            storage.flush()
+            self.assertEqual(len(calls), 2)
+            apps = storage._write.get_applications('t@m.com', 'blah', 0,
+                                                   None)
+            self.assertEqual([app for __, app in apps], [{'origin': 'app1'}])
+
+            snapshot = metrics.snapshot()
+            self.assertEqual(snapshot['counters']['mirror.retries'], 1)
+            self.assertEqual(snapshot['gauges']['mirror.queue'], 0)
+            self.assertEqual(snapshot['timers']['mirror.lag']['count'], 1)
+        finally:
+            self._clear()
+
+    def test_hedged_reads(self):
+        storage = self._mirrored(read_policy='hedged', hedge_after='20')
+        storage.add_applications('t@m.com', 'blah', [{'origin': 'app1'}],
+                                 'token')
+        primary = storage._readwrite
+        mirror = storage._write
+        snapshot = primary.get_collection_snapshot
+        uuid = primary.get_uuid('t@m.com', 'blah', 'token')
+        mirror_uuid = mirror.get_uuid('t@m.com', 'blah', None)
+
+        def slow(*args, **kw):
+            time.sleep(.5)
+            return snapshot(*args, **kw)
+
+        def broken(*args, **kw):
+            raise ValueError('Boom')
+
+        def read():
+            uuid, __, apps = storage.get_collection_snapshot('t@m.com',
+                                                             'blah', 0,
+                                                             'token')
+            self.assertEqual([pair[1] for pair in apps], [{'origin': 'app1'}])
+            return uuid
+
+        try:
+            self.assertEqual(read(), uuid)
+
+            # the mirror answers when the primary is slow
+            primary.get_collection_snapshot = slow
+            start = time.time()
+            self.assertEqual(read(), mirror_uuid)
+            self.assertTrue(time.time() - start < .5)
+
+            # and the collection sticks to it, so the uuid does not change
+            del primary.get_collection_snapshot
+            self.assertEqual(read(), mirror_uuid)
+
+            # until it breaks
+            mirror.get_collection_snapshot = broken
+            self.assertEqual(read(), uuid)
+
+            # the unknown tokens are not accepted by any backend
+            self.assertRaises(StorageAuthError,
+                              storage.get_collection_snapshot, 't@m.com',
+                              'blah', 0, 'badtoken')
+
+            # the other reads always go to the primary
+            primary.get_uuid = broken
+            self.assertRaises(ValueError, storage.get_uuid, 't@m.com',
+                              'blah', 'token')
+
+            counters = metrics.snapshot()['counters']
+            self.assertEqual(counters['mirror.hedged'], 1)
+            self.assertEqual(counters['mirror.failovers'], 1)
+        finally:
+            self._clear()
+
+    def test_fastest_reads(self):
+        storage = self._mirrored(read_policy='fastest')
+        for collection in ('blah', 'blah2'):
+            storage.add_applications('t@m.com', collection,
+                                     [{'origin': 'app1'}], 'token')
+        calls = []
+
+        def broken(*args, **kw):
+            calls.append(args)
+            raise ValueError('Boom')
+
+        storage._readwrite.get_collection_snapshot = broken
+        try:
+            for i in range(10):
+                uuid, __, apps = storage.get_collection_snapshot(
+                        't@m.com', 'blah', 0, token='token')
+                self.assertEqual([pair[1] for pair in apps],
+                                 [{'origin': 'app1'}])
+
+            # once failed over, the collection is read from the mirror
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(uuid, storage._write.get_uuid('t@m.com', 'blah',
+                                                           None))
+
+            # the other collections go to the healthiest backend
+            storage._health['readwrite'].record(1, failed=True)
+            storage._health['readwrite'].record(1, failed=True)
+            storage._health['readwrite'].record(1, failed=True)
+            self.assertFalse(storage._health['readwrite'].healthy)
+            storage.get_collection_snapshot('t@m.com', 'blah2', 0, 'token')
+            self.assertEqual(len(calls), 1)
+        finally:
+            self._clear()
+
+    def test_pins_are_shared(self):
+        storage = self._mirrored(read_policy='fastest')
+        other = self._mirrored(read_policy='fastest')
+        # the processes share the cache
+        other._readwrite.cache = storage._readwrite.cache
+        storage.add_applications('t@m.com', 'blah', [{'origin': 'app1'}],
+                                 'token')
+        calls = []
+
+        def broken(*args, **kw):
+            calls.append(args)
+            raise ValueError('Boom')
+
+        try:
+            storage._readwrite.get_collection_snapshot = broken
+            storage.get_collection_snapshot('t@m.com', 'blah', 0, 'token')
+            self.assertEqual(len(calls), 1)
+
+            # the other process reads the collection from the mirror too
+            other._readwrite.get_collection_snapshot = broken
+            uuid = other.get_collection_snapshot('t@m.com', 'blah', 0,
+                                                 'token')[0]
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(uuid, other._write.get_uuid('t@m.com', 'blah',
+                                                         None))
+        finally:
+            self._clear()
+
+    def test_hedge_pool_is_bounded(self):
+        storage = self._mirrored(read_policy='hedged', hedge_threads='1')
+        storage.add_applications('t@m.com', 'blah', [{'origin': 'app1'}],
+                                 'token')
+        try:
+            # without two free threads, the request reads by itself
+            apps = storage.get_collection_snapshot('t@m.com', 'blah', 0,
+                                                   'token')[2]
+            self.assertEqual([app for __, app in apps], [{'origin': 'app1'}])
+            counters = metrics.snapshot()['counters']
+            self.assertEqual(counters['mirror.hedge_full'], 1)
+            self.assertEqual(storage._hedging, 0)
+        finally:
+            self._clear()
+
+    def test_journal(self):
+        storage = self._mirrored(journal=_JOURNAL, replay_interval='60')
+        other = self._mirrored(journal=_JOURNAL, replay_interval='60')
+        write = storage._write
+
+        def broken(*args, **kw):
+            raise ValueError('Boom')
+
+        def get_apps():
+            apps = write.get_applications('t@m.com', 'blah', 0, None)
+            return [app['origin'] for __, app in apps]
+
+        try:
+            # the mirror is down, the client does not see it
+            write.add_applications = broken
+            storage.add_applications('t@m.com', 'blah', [{'origin': 'app1'}],
+                                     'token')
+            del write.add_applications
+
+            # the next writes wait for the journal to be replayed
+            storage.add_applications('t@m.com', 'blah', [{'origin': 'app2'}],
+                                     token='token')
+            self.assertEqual(get_apps(), [])
+            self.assertTrue(storage._journal.pending() > 0)
+
+            # without the tokens
+            with open(_JOURNAL) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(records[0]['args'][-1], None)
+            self.assertEqual(records[1]['kw']['token'], None)
+
+            # the other processes don't read the journal for each write
+            self.assertFalse(other._journaled)
+
+            self.assertEqual(other.replay(), 2)
+            self.assertEqual(sorted(get_apps()), ['app1', 'app2'])
+            self.assertEqual(storage._journal.pending(), 0)
+            self.assertTrue(storage._journaled)
+            self.assertEqual(storage.replay(), 0)
+            self.assertFalse(storage._journaled)
+
+            # the writes go to the mirror again
+            storage.add_applications('t@m.com', 'blah', [{'origin': 'app3'}],
+                                     'token')
+            self.assertEqual(len(get_apps()), 3)
+
+            counters = metrics.snapshot()['counters']
+            self.assertEqual(counters['mirror.journal.appended'], 2)
+            self.assertEqual(counters['mirror.journal.replayed'], 2)
+        finally:
+            self._clear()
@@ -0,0 +1,29 @@
+import threading
+import time
+import unittest
+
+from appsync.notify import LocalNotifier
+
+
+class TestLocalNotifier(unittest.TestCase):
+
+    def test_publish(self):
+        notifier = LocalNotifier()
+
+        def publish():
+            time.sleep(.1)
+            notifier.publish('tarek', 'other')
+            notifier.publish('tarek', 'apps')
+
+        with notifier.listen('tarek', 'apps') as changed:
+            threading.Thread(target=publish).start()
+            start = time.time()
+            changed.wait(5)
+            self.assertTrue(changed.is_set())
+            self.assertTrue(time.time() - start < 1)
+
+        # nobody is listening anymore
+        with notifier.listen('tarek', 'apps') as changed:
+            changed.wait(.01)
+            self.assertFalse(changed.is_set())
+        self.assertEqual(notifier._listeners, {})
@@ -0,0 +1,54 @@
+import time
+import unittest
+
+from appsync.metrics import metrics
+from appsync.poll import Load, PollPolicy
+from appsync.tests.test_server import FakeCache
+
+
+class TestPollPolicy(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_global(self):
+        policy = PollPolicy(cache_ttl=.1, refresh_thread=False)
+        cache = FakeCache()
+        self.assertEqual(policy.get_interval(cache), None)
+
+        # the value is kept in memory for a while
+        cache.set('X-Sync-Poll', 20)
+        self.assertEqual(policy.get_interval(cache), None)
+        time.sleep(.15)
+        self.assertEqual(policy.get_interval(cache), 20)
+        self.assertEqual(metrics.snapshot()['gauges']['poll.global'], 20)
+
+    def test_adaptive(self):
+        policy = PollPolicy(adaptive=True, min_interval=10, max_interval=600,
+                            activity_ratio=.1, target_latency=.5)
+        now = time.time()
+        self.assertEqual(policy.get_interval(None, now), 10)
+        self.assertEqual(policy.get_interval(None, now - 1000), 100)
+        self.assertEqual(policy.get_interval(None, now - 100000), 600)
+        self.assertEqual(policy.get_interval(None), 600)
+
+        # the clients poll less often when the requests are slow
+        policy.load.latency = 1.
+        self.assertEqual(policy.load_factor(), 2)
+        self.assertEqual(policy.get_interval(None, now - 1000), 200)
+
+        # the backoff value is a minimum
+        cache = FakeCache({'X-Sync-Poll': 300})
+        self.assertEqual(policy.get_interval(cache, now), 300)
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_rate(self):
+        load = Load(window=.1)
+        for i in range(5):
+            load.record(.01)
+        self.assertEqual(load.get_rate(), 0)
+        time.sleep(.11)
+        self.assertTrue(40 < load.get_rate() < 50)
+        self.assertTrue(0 < load.latency < .01)
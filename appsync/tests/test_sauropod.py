@@ -1,6 +1,8 @@
 import os
 import collections
 import json
+import time
+import threading
 
 from webob.dec import wsgify
 from appsync.tests.test_server import TestSyncApp
@@ -44,11 +46,14 @@ class FakeSauropod(object):
 
     _data = collections.defaultdict(dict)
     hits = 0
+    # latency added to each read, in seconds
+    delay = 0
 
     @classmethod
     def clear(cls):
         cls._data.clear()
         cls.hits = 0
+        cls.delay = 0
 
     @classmethod
     def incr_hit(cls):
@@ -83,6 +88,7 @@ class FakeSauropod(object):
             user = parts[-3]
             key = parts[-1]
             if request.method == 'GET':
+                time.sleep(self.delay)
                 try:
                     response.body = json.dumps({'value':
                         self._data[user][key]})
@@ -148,3 +154,75 @@ class TestSauropod(TestSyncApp):
 
         # when cache is enabled, we hits more than two times the DB
         self.assertTrue(hits_with_cache * 2 < hits_no_cache)
+
+    def test_updates_order(self):
+        extra = self._start_session()
+        for update in (['app1', 'app2', 'app3'], ['app2'], ['app4', 'app1']):
+            apps = [{'origin': origin} for origin in update]
+            self.app.post('/collections/t@m.com/blah',
+                          params=json.dumps(apps), extra_environ=extra,
+                          content_type='application/json')
+            # the precision of the timestamps are .01
+            time.sleep(.01)
+
+        # the apps are returned from the oldest update
+        data = self.app.get('/collections/t@m.com/blah',
+                            extra_environ=extra).json
+        origins = [app['origin'] for app in data['applications']]
+        self.assertEqual(origins, ['app3', 'app2', 'app1', 'app4'])
+
+    def test_concurrent_fetches(self):
+        extra = self._start_session()
+        apps = [{'origin': 'app%d' % i} for i in range(20)]
+        self.app.post('/collections/t@m.com/blah', params=json.dumps(apps),
+                      extra_environ=extra, content_type='application/json')
+
+        storage = self.config.registry.getUtility(IAppSyncDatabase)
+        get_item = storage._get_item
+        fetches = {'running': 0, 'overlap': 0}
+        lock = threading.Lock()
+
+        # counts the fetches running at the same time
+        def _get_item(session, key):
+            with lock:
+                fetches['running'] += 1
+                fetches['overlap'] = max(fetches['overlap'],
+                                         fetches['running'])
+            try:
+                time.sleep(.01)
+                return get_item(session, key)
+            finally:
+                with lock:
+                    fetches['running'] -= 1
+
+        def get_apps(concurrency):
+            fetches['overlap'] = 0
+            storage.fetch_concurrency = concurrency
+            data = self.app.get('/collections/t@m.com/blah',
+                                extra_environ=extra).json
+            return data['applications'], fetches['overlap']
+
+        old = storage.fetch_concurrency
+        storage._get_item = _get_item
+        try:
+            serial, serial_overlap = get_apps(1)
+            concurrent, concurrent_overlap = get_apps(10)
+        finally:
+            storage.fetch_concurrency = old
+            del storage._get_item
+
+        # same apps, same order, fetched at the same time
+        self.assertEqual(len(serial), 20)
+        self.assertEqual(concurrent, serial)
+        self.assertEqual(serial_overlap, 1)
+        self.assertTrue(concurrent_overlap > 1)
+
+    def test_fetch_pool(self):
+        storage = self.config.registry.getUtility(IAppSyncDatabase)
+        pool = storage._get_fetch_pool()
+        self.assertTrue(storage._get_fetch_pool() is pool)
+
+        # a forked process creates its own
+        storage._fetch_pid = -1
+        self.assertFalse(storage._get_fetch_pool() is pool)
+        pool.close()
@@ -1,6 +1,7 @@
 import os
 import shutil
 import unittest
+import threading
 import time
 import json
 
@@ -13,7 +14,13 @@ from mozsvc.config import load_into_settings
 import vep
 
 from appsync import CatchAuthError
+from appsync.auth import create_auth
+from appsync.cache import CacheError
+from appsync.metrics import metrics
+from appsync.notify import INotifier
+from appsync.poll import PollPolicy
 from appsync.storage import IAppSyncDatabase, ServerError
+from appsync.util import TokenSigner
 from appsync.tests.support import memcache_up
 
 
@@ -36,6 +43,31 @@ class FakeCache(dict):
     def set(self, key, value, *args, **kw):
         self[key] = value
 
+    def delete(self, key):
+        return self.pop(key, None) is not None
+
+    def get_multi(self, keys):
+        return dict((key, self[key]) for key in keys if key in self)
+
+    def add(self, key, value, *args, **kw):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+    def set_multi(self, mapping, *args, **kw):
+        self.update(mapping)
+
+    def delete_multi(self, keys):
+        return all([self.delete(key) for key in keys])
+
+
+class DownCache(object):
+    def get(self, key):
+        raise CacheError()
+
+    set = add = delete = get_multi = set_multi = delete_multi = get
+
 
 class TestSyncApp(unittest.TestCase):
 
@@ -172,7 +204,7 @@ class TestSyncApp(unittest.TestCase):
         # getting again, with since=now
         since = time.time()
         data = self.app.get('/collections/t@m.com/blah?since=%s' % since,
-                             extra_environ=extra).json
+                            extra_environ=extra).json
 
         # nothing has changed, empty apps
         self.assertEqual(len(data['applications']), 0)
@@ -251,10 +283,293 @@ class TestSyncApp(unittest.TestCase):
                       content_type='application/json',
                       status=412)
 
+    def test_raw_json(self):
+        # the apps are sent back as they were stored
+        storage = self.config.registry.getUtility(IAppSyncDatabase)
+        if not hasattr(storage, 'raw_json'):
+            return
+
+        storage.raw_json = True
+        try:
+            self.test_protocol()
+        finally:
+            storage.raw_json = False
+
+    def _start_session(self):
+        audience = "http://myapps.mozillalabs.com/"
+        assertion = vep.DummyVerifier.make_assertion("t@m.com", audience)
+        login_data = {'assertion': assertion,
+                      'audience': audience}
+        resp = self.app.post('/verify', login_data)
+        auth = resp.json["http_authorization"].encode("ascii")
+        return {'HTTP_AUTHORIZATION': auth}
+
+    def test_signed_tokens(self):
+        storage = self.config.registry.getUtility(IAppSyncDatabase)
+        backend = getattr(storage, '_readwrite', storage)
+        if not hasattr(backend, 'token_signer'):
+            return
+
+        signer = TokenSigner('secret')
+        storage.token_signer = backend.token_signer = signer
+        old_cache = backend.cache
+        # the sessions don't need memcached anymore
+        backend.cache = DownCache()
+        try:
+            extra = self._start_session()
+            self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+
+            # a valid token, but for someone else
+            audience = "http://myapps.mozillalabs.com/"
+            token = signer.sign('o@m.com', audience)
+            auth = create_auth('assertion', 't@m.com', token)
+            self.app.get('/collections/t@m.com/blah', status=401,
+                         extra_environ={'HTTP_AUTHORIZATION': auth})
+
+            # a forged one
+            token = TokenSigner('other').sign('t@m.com', audience)
+            auth = create_auth('assertion', 't@m.com', token)
+            self.app.get('/collections/t@m.com/blah', status=401,
+                         extra_environ={'HTTP_AUTHORIZATION': auth})
+        finally:
+            storage.token_signer = backend.token_signer = None
+            backend.cache = old_cache
+
+    def test_paging(self):
+        extra = self._start_session()
+        settings = self.config.registry.settings
+        settings['global.max_applications'] = '2'
+
+        # three updates, the first one has two apps
+        apps = [{'origin': 'app1'}, {'origin': 'app2'}]
+        for update in (apps, [{'origin': 'app3'}], [{'origin': 'app4'}]):
+            self.app.post('/collections/t@m.com/blah',
+                          params=json.dumps(update), extra_environ=extra,
+                          content_type='application/json')
+            # the precision of the timestamps are .01
+            time.sleep(.01)
+
+        try:
+            # apps modified at the same time are never split
+            data = self.app.get('/collections/t@m.com/blah',
+                                extra_environ=extra).json
+            self.assertEqual(len(data['applications']), 2)
+            self.assertTrue(data['incomplete'])
+
+            settings['global.max_applications'] = '1'
+            data = self.app.get('/collections/t@m.com/blah',
+                                extra_environ=extra).json
+            self.assertEqual(len(data['applications']), 2)
+            self.assertTrue(data['incomplete'])
+
+            # the next page
+            data = self.app.get('/collections/t@m.com/blah?since=%s' %
+                                data['until'], extra_environ=extra).json
+            self.assertEqual(data['applications'], [{'origin': 'app3'}])
+            self.assertTrue(data['incomplete'])
+
+            # the last one
+            data = self.app.get('/collections/t@m.com/blah?since=%s' %
+                                data['until'], extra_environ=extra).json
+            self.assertEqual(data['applications'], [{'origin': 'app4'}])
+            self.assertFalse('incomplete' in data)
+        finally:
+            del settings['global.max_applications']
+
+    def test_streaming(self):
+        settings = self.config.registry.settings
+        settings['global.stream_applications'] = 'true'
+        try:
+            self.test_protocol()
+            self.test_paging()
+        finally:
+            del settings['global.stream_applications']
+
+    def test_etag(self):
+        storage = self.config.registry.getUtility(IAppSyncDatabase)
+        if not hasattr(storage, 'get_collection_snapshot'):
+            return
+
+        extra = self._start_session()
+        apps = json.dumps([{'origin': 'app1'}])
+        self.app.post('/collections/t@m.com/blah', params=apps,
+                      extra_environ=extra, content_type='application/json')
+        resp = self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+        etag = resp.headers['ETag']
+        until = resp.json['until']
+
+        # nothing new
+        extra['HTTP_IF_NONE_MATCH'] = etag
+        resp = self.app.get('/collections/t@m.com/blah?since=%s' % until,
+                            extra_environ=extra, status=304)
+        self.assertEqual(resp.body, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        # the client asks for older items it does not have
+        resp = self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+        self.assertEqual(len(resp.json['applications']), 1)
+
+        # the collection changed
+        time.sleep(.01)
+        apps = json.dumps([{'origin': 'app2'}])
+        self.app.post('/collections/t@m.com/blah', params=apps,
+                      extra_environ=extra, content_type='application/json')
+        resp = self.app.get('/collections/t@m.com/blah?since=%s' % until,
+                            extra_environ=extra)
+        self.assertEqual(resp.json['applications'], [{'origin': 'app2'}])
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_invalid_origin(self):
+        extra = self._start_session()
+
+        # origins too long to be indexed are rejected
+        for origin in (None, 'http://' + 'x' * 249):
+            apps = json.dumps([{'origin': origin}])
+            self.app.post('/collections/t@m.com/blah', params=apps,
+                          extra_environ=extra,
+                          content_type='application/json', status=400)
+
+        apps = json.dumps([{'origin': 'http://' + 'x' * 248}])
+        self.app.post('/collections/t@m.com/blah', params=apps,
+                      extra_environ=extra, content_type='application/json')
+
+    def test_changes(self):
+        settings = self.config.registry.settings
+        settings['global.longpoll'] = 'true'
+        try:
+            self._test_changes()
+        finally:
+            del settings['global.longpoll']
+
+    def test_changes_disabled(self):
+        extra = self._start_session()
+        settings = self.config.registry.settings
+
+        # without long-polling, or when too many requests are waiting,
+        # the requests are answered right away
+        for longpoll, max_waiting in (('false', '10'), ('true', '0')):
+            settings['global.longpoll'] = longpoll
+            settings['global.longpoll_max_waiting'] = max_waiting
+            try:
+                start = time.time()
+                data = self.app.get('/collections/t@m.com/blah/changes'
+                                    '?since=0&timeout=10',
+                                    extra_environ=extra).json
+                self.assertTrue(time.time() - start < 2)
+                self.assertEqual(data['applications'], [])
+            finally:
+                del settings['global.longpoll']
+                del settings['global.longpoll_max_waiting']
+
+    def _test_changes(self):
+        extra = self._start_session()
+        apps = json.dumps([{'origin': 'app1'}])
+        self.app.post('/collections/t@m.com/blah', params=apps,
+                      extra_environ=extra, content_type='application/json')
+
+        # the changes since 0 are sent right away
+        data = self.app.get('/collections/t@m.com/blah/changes',
+                            extra_environ=extra).json
+        self.assertEqual(data['applications'], [{'origin': 'app1'}])
+        until = data['until']
+
+        # nothing changed
+        data = self.app.get('/collections/t@m.com/blah/changes?since=%s'
+                            '&timeout=0.1' % until, extra_environ=extra).json
+        self.assertEqual(data['applications'], [])
+        self.app.get('/collections/t@m.com/blah/changes?timeout=bad',
+                     extra_environ=extra, status=400)
+
+        if self.config.registry.queryUtility(INotifier) is None:
+            return
+
+        # the writes of this process wake the request up
+        def post():
+            time.sleep(.2)
+            apps = json.dumps([{'origin': 'app2'}])
+            self.app.post('/collections/t@m.com/blah', params=apps,
+                          extra_environ=extra,
+                          content_type='application/json')
+
+        threading.Thread(target=post).start()
+        start = time.time()
+        data = self.app.get('/collections/t@m.com/blah/changes?since=%s'
+                            '&timeout=10' % until, extra_environ=extra).json
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(data['applications'], [{'origin': 'app2'}])
+        until = data['until']
+
+        # and so does a deletion
+        def delete():
+            time.sleep(.2)
+            delete = {'client_id': 'client1', 'reason': 'reason'}
+            self.app.post('/collections/t@m.com/blah?delete',
+                          extra_environ=extra, params=json.dumps(delete),
+                          content_type='application/json')
+
+        threading.Thread(target=delete).start()
+        start = time.time()
+        data = self.app.get('/collections/t@m.com/blah/changes?since=%s'
+                            '&timeout=10' % until, extra_environ=extra).json
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(data.keys(), ['collection_deleted'])
+
+        # there is nothing to wait for in a deleted collection
+        start = time.time()
+        data = self.app.get('/collections/t@m.com/blah/changes?since=%s'
+                            '&timeout=10' % until, extra_environ=extra).json
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(data.keys(), ['collection_deleted'])
+
+    def test_adaptive_poll(self):
+        extra = self._start_session()
+        resp = self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+        self.assertFalse('X-Sync-Poll' in resp.headers)
+
+        # an empty collection is idle
+        self.config.registry['poll_policy'] = PollPolicy(adaptive=True,
+                                                         min_interval=10,
+                                                         max_interval=600)
+        resp = self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+        self.assertEqual(resp.headers['X-Sync-Poll'], '600')
+
+        # an active one is polled more often
+        apps = json.dumps([{'origin': 'app1'}])
+        self.app.post('/collections/t@m.com/blah', params=apps,
+                      extra_environ=extra, content_type='application/json')
+        resp = self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+        self.assertEqual(resp.headers['X-Sync-Poll'], '10')
+
     def test_heartbeat(self):
         res = self.app.get('/__heartbeat__')
         self.assertEqual(res.body, 'OK')
 
+    def test_stats(self):
+        settings = self.config.registry.settings
+        self.app.get('/__stats__', status=403)
+
+        metrics.reset()
+        settings['global.stats'] = 'true'
+        try:
+            extra = self._start_session()
+            self.app.get('/collections/t@m.com/blah', extra_environ=extra)
+            self.app.get('/__heartbeat__')
+            self.app.get('/collections/t@m.com/blah', status=401)
+            stats = self.app.get('/__stats__').json
+        finally:
+            del settings['global.stats']
+            metrics.reset()
+
+        timers = stats['timers']
+        self.assertEqual(timers['request.verify']['count'], 1)
+        self.assertEqual(timers['request.data.GET']['count'], 2)
+        self.assertEqual(timers['request.heartbeat']['count'], 1)
+        self.assertTrue('request.data.GET.storage' in timers)
+        counters = stats['counters']
+        self.assertEqual(counters['status.200'], 3)
+        self.assertEqual(counters['status.401'], 1)
+        self.assertEqual(counters['bytes.heartbeat'], 2)
+
     def test_503(self):
         storage = self.config.registry.getUtility(IAppSyncDatabase)
         old = storage.verify
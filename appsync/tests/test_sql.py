@@ -0,0 +1,515 @@
+import os
+import sqlite3
+import time
+import unittest
+import json
+from StringIO import StringIO
+
+from webob import Request
+from webob.dec import wsgify
+from vep import DummyVerifier
+
+from sqlalchemy import create_engine, event, String
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+from appsync.cache import LocalCache
+from appsync.metrics import metrics
+from appsync.storage import (sql, CollectionDeletedError, StorageAuthError,
+                             ServerError, ConnectionError, MAX_KEY_LENGTH)
+from appsync.tests.test_server import FakeCache
+from appsync.storage.sql import (_TABLES, applications, create_indexes,
+                                 SQLDatabase)
+
+
+_DB = '/tmp/appsync-test-sql.db'
+
+
+class KeyServer(object):
+    """Stand-in for the issuers, serving the dummy public keys."""
+    hits = 0
+    down = False
+
+    @wsgify
+    def __call__(self, request):
+        KeyServer.hits += 1
+        if KeyServer.down:
+            request.response.status = 503
+            return request.response
+        if request.path_info != '/.well-known/vep':
+            request.response.status = 404
+            return request.response
+        key = DummyVerifier.fetch_public_key(request.host.split(':')[0])
+        request.response.body = json.dumps({'public-key': key})
+        return request.response
+
+
+def urlopen(url, data=None):
+    response = Request.blank(url).get_response(KeyServer())
+    if response.status_int != 200:
+        raise ValueError(response.status)
+    return StringIO(response.body)
+
+
+class TestSQLSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///' + _DB)
+
+    def tearDown(self):
+        if os.path.exists(_DB):
+            os.remove(_DB)
+
+    def test_migration(self):
+        # tables from a previous version, without any index
+        for table in _TABLES:
+            table.create(bind=self.engine)
+            for index in table.indexes:
+                index.drop(bind=self.engine)
+
+        app = {'user': 'tarek', 'collection': 'apps', 'origin': 'app1'}
+        for last_modified in (1, 3, 2):
+            self.engine.execute(applications.insert(), data=str(last_modified),
+                                last_modified=last_modified, **app)
+
+        # on a tie, the last inserted row wins
+        app['origin'] = 'app2'
+        for data in ('a', 'b'):
+            self.engine.execute(applications.insert(), data=data,
+                                last_modified=5, **app)
+
+        created = create_indexes(self.engine)
+        self.assertEqual(len(created), 4)
+
+        # the duplicates are gone, the last modified row was kept
+        rows = self.engine.execute(applications.select()).fetchall()
+        self.assertEqual(sorted((row.origin, row.data) for row in rows),
+                         [('app1', '3'), ('app2', 'b')])
+
+        inspector = Inspector.from_engine(self.engine)
+        indexes = inspector.get_indexes('applications')
+        unique = [index['column_names'] for index in indexes
+                  if index['unique']]
+        self.assertEqual(unique, [['user', 'collection', 'origin']])
+
+        # running it again is harmless
+        self.assertEqual(create_indexes(self.engine), [])
+
+        # so is losing the race against another process
+        for index in applications.indexes:
+            self.assertFalse(sql._create_index(self.engine, index))
+
+    def test_indexed_columns(self):
+        # the indexed strings fit entirely in a MySQL index
+        for table in _TABLES:
+            for index in table.indexes:
+                for column in index.columns:
+                    if isinstance(column.type, String):
+                        length = column.type.length
+                        self.assertTrue(length <= MAX_KEY_LENGTH)
+
+
+class TestSQLPool(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        sql.create_engine = create_engine
+        if os.path.exists(_DB):
+            os.remove(_DB)
+
+    def test_checkout_metrics(self):
+        pool = sql.TimedQueuePool(lambda: sqlite3.connect(_DB), pool_size=1,
+                                  max_overflow=0, timeout=.1)
+        conn = pool.connect()
+
+        # the only connection is taken
+        self.assertRaises(TimeoutError, pool.connect)
+        conn.close()
+        pool.connect().close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['sql.pool.timeouts'], 1)
+        timer = snapshot['timers']['sql.pool.checkout']
+        self.assertEqual(timer['count'], 3)
+        self.assertTrue(timer['max'] >= .1)
+
+    def test_ping_connection(self):
+        engine = create_engine('sqlite:///' + _DB,
+                               poolclass=sql.TimedQueuePool, pool_size=1)
+        event.listen(engine, 'checkout', sql.ping_connection)
+        conn = engine.connect()
+        dbapi_conn = conn.connection.connection
+        conn.close()
+        # the server closed it while it was in the pool
+        dbapi_conn.close()
+
+        # a new connection is used
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['sql.pool.disconnects'], 1)
+
+    def test_options(self):
+        calls = []
+
+        def _create_engine(sqluri, **kw):
+            calls.append((sqluri, kw))
+            return create_engine('sqlite:///' + _DB)
+
+        sql.create_engine = _create_engine
+        db = SQLDatabase(sqluri='mysql://appsync@localhost/appsync',
+                         pool_size='7', max_overflow='3', pool_timeout='5',
+                         pool_recycle='60', pool_pre_ping='true')
+        self.assertEqual(calls, [('mysql://appsync@localhost/appsync',
+                                  {'logging_name': 'appsync',
+                                   'poolclass': sql.TimedQueuePool,
+                                   'pool_size': 7, 'max_overflow': 3,
+                                   'pool_timeout': 5, 'pool_recycle': 60})])
+        self.assertTrue(sql.ping_connection in
+                        db.engine.pool.dispatch.checkout)
+
+        # SQLite has no queue pool
+        del calls[:]
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, pool_size='7')
+        self.assertEqual(calls, [('sqlite:///' + _DB,
+                                  {'logging_name': 'appsync'})])
+        self.assertFalse(sql.ping_connection in
+                         db.engine.pool.dispatch.checkout)
+
+
+class TestSQLDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SQLDatabase(sqluri='sqlite:///' + _DB)
+        self.db.set_authentication(False)
+
+    def tearDown(self):
+        if os.path.exists(_DB):
+            os.remove(_DB)
+
+    def _apps(self):
+        return dict((app['origin'], app['version']) for __, app in
+                    self.db.get_applications('tarek', 'apps', 0, None))
+
+    def _test_add_applications(self):
+        apps = [{'origin': 'app%d' % i, 'version': 1} for i in range(3)]
+        self.db.add_applications('tarek', 'apps', apps, None)
+        self.assertEqual(self._apps(), {'app0': 1, 'app1': 1, 'app2': 1})
+
+        # updates and additions in the same batch, the last one wins
+        apps = [{'origin': 'app1', 'version': 2},
+                {'origin': 'app3', 'version': 1},
+                {'origin': 'app1', 'version': 3}]
+        self.db.add_applications('tarek', 'apps', apps, None)
+        self.assertEqual(self._apps(), {'app0': 1, 'app1': 3, 'app2': 1,
+                                        'app3': 1})
+
+    def test_add_applications(self):
+        self._test_add_applications()
+
+    def test_add_applications_no_upsert(self):
+        self.db._upsert = None
+        self._test_add_applications()
+
+    def test_upsert_needs_unique_index(self):
+        self.assertTrue(self.db._upsert is not None)
+        self.assertTrue(sql.has_unique_origins(self.db.engine))
+
+        # a table from a previous version, left as it was
+        for index in applications.indexes:
+            index.drop(bind=self.db.engine)
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, create_indexes='false')
+        db.set_authentication(False)
+        self.assertEqual(db._upsert, None)
+        self.db = db
+        self._test_add_applications()
+
+    def test_lazy_applications(self):
+        self.db.yield_per = 2
+        apps = [{'origin': 'app%d' % i} for i in range(5)]
+        self.db.add_applications('tarek', 'apps', apps, None)
+
+        apps = self.db.get_applications('tarek', 'apps', 0, None)
+        self.assertTrue('origin' in next(apps)[1])
+        self.assertEqual(len(list(apps)), 4)
+
+        __, __, apps = self.db.get_collection_snapshot('tarek', 'apps', 0,
+                                                       None)
+        self.assertEqual(len(list(apps)), 5)
+
+    def test_snapshot(self):
+        uuid, last_modified, apps = self.db.get_collection_snapshot(
+                'tarek', 'apps', 0, None)
+        self.assertEqual((uuid, last_modified, list(apps)), (None, None, []))
+
+        apps = [{'origin': 'app1'}, {'origin': 'app2'}]
+        self.db.add_applications('tarek', 'apps', apps, None)
+        uuid, last_modified, apps = self.db.get_collection_snapshot(
+                'tarek', 'apps', 0, None)
+        self.assertEqual(uuid, self.db.get_uuid('tarek', 'apps', None))
+        self.assertEqual(last_modified,
+                         self.db.get_last_modified('tarek', 'apps', None))
+        self.assertEqual(len(list(apps)), 2)
+
+        # nothing changed since the last write
+        __, __, apps = self.db.get_collection_snapshot(
+                'tarek', 'apps', last_modified, None)
+        self.assertEqual(list(apps), [])
+
+        self.db.delete('tarek', 'apps', 'client', 'reason', None)
+        self.assertRaises(CollectionDeletedError,
+                          self.db.get_collection_snapshot, 'tarek', 'apps',
+                          0, None)
+
+    def test_lazy_errors(self):
+        class Result(object):
+            closed = False
+
+            def fetchmany(self, size):
+                raise OperationalError('select', {}, Exception('Gone'))
+
+            def fetchone(self):
+                raise OperationalError('select', {}, Exception('Gone'))
+
+            def close(self):
+                self.closed = True
+
+        res = Result()
+        apps = self.db._iter_applications(res)
+        self.assertRaises(ServerError, list, apps)
+        self.assertTrue(res.closed)
+
+        # the first row of a snapshot too
+        res = Result()
+        self.db._stream = lambda *args, **kw: res
+        self.assertRaises(ServerError, self.db.get_collection_snapshot,
+                          'tarek', 'apps', 0, None)
+        self.assertTrue(res.closed)
+
+    def test_local_cache(self):
+        self.assertFalse(isinstance(self.db.cache, LocalCache))
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, local_cache_size='10',
+                         session_ttl='2')
+        self.assertTrue(isinstance(db.cache, LocalCache))
+        # the tokens are not kept longer than the sessions
+        self.assertEqual(db.cache.ttl, 2)
+
+        # but the metadata are not kept at all
+        db.cache.cache = FakeCache()
+        db.cache_activated = True
+        db.set_authentication(False)
+        db.add_applications('tarek', 'apps', [{'origin': 'app1'}], None)
+        self.assertEqual(db.cache._items.keys(), [])
+        # once the write guard expired
+        db.cache.cache.clear()
+        db.get_uuid('tarek', 'apps', None)
+        meta = db.cache.cache[sql._meta_key('tarek', 'apps')]
+        self.assertEqual(db.get_uuid('tarek', 'apps', None), meta['uuid'])
+        self.assertEqual(db.cache._items.keys(), [])
+
+    def test_token_expiry(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, verifier=DummyVerifier,
+                         local_cache_size='10', session_ttl='1')
+        db.cache.cache = FakeCache()
+        audience = 'http://myapps.mozillalabs.com/'
+        assertion = DummyVerifier.make_assertion('t@m.com', audience)
+        __, token = db.verify(assertion, audience)
+        db.get_uuid('tarek', 'apps', token)
+        key = sql._token_key(token)
+        self.assertEqual(db.cache._items.keys(), [key])
+
+        # the token is still in memory, but it expired
+        db.cache.ttl = 10
+        db.cache.set(key, db.cache.get(key))
+        time.sleep(1.1)
+        self.assertRaises(StorageAuthError, db.get_uuid, 'tarek', 'apps',
+                          token)
+
+    def test_legacy_tokens(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB)
+        db.cache = FakeCache()
+        # cached by a previous version, without the prefix
+        db.cache['token'] = ('t@m.com', 'audience')
+        db.get_uuid('tarek', 'apps', 'token')
+        del db.cache['token']
+        self.assertRaises(StorageAuthError, db.get_uuid, 'tarek', 'apps',
+                          'token')
+
+    def test_cache_assertions(self):
+        calls = []
+
+        class Verifier(DummyVerifier):
+            def verify(self, assertion, audience=None):
+                calls.append(assertion)
+                return DummyVerifier.verify(self, assertion, audience)
+
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, verifier=Verifier,
+                         cache_assertions='true')
+        db.cache = FakeCache()
+        audience = 'http://myapps.mozillalabs.com/'
+        metrics.reset()
+        try:
+            assertion = DummyVerifier.make_assertion('t@m.com', audience)
+            for i in range(3):
+                self.assertEqual(db.verify(assertion, audience)[0], 't@m.com')
+            self.assertEqual(len(calls), 1)
+
+            # it's not cached beyond its expiry date
+            exp = int((time.time() + .5) * 1000)
+            assertion = DummyVerifier.make_assertion('t@m.com', audience,
+                                                     exp=exp)
+            for i in range(2):
+                db.verify(assertion, audience)
+            self.assertEqual(len(calls), 3)
+
+            snapshot = metrics.snapshot()
+            self.assertEqual(snapshot['counters']['verifier.cache.hits'], 2)
+            self.assertEqual(snapshot['timers']['verifier.verify']['count'], 3)
+        finally:
+            metrics.reset()
+
+    def test_local_verifier(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, verifier='local',
+                         verifier_refresh='0.1',
+                         verifier_urlopen='appsync.tests.test_sql.urlopen')
+        db.cache = FakeCache()
+        audience = 'http://myapps.mozillalabs.com/'
+        assertion = DummyVerifier.make_assertion('t@m.com', audience)
+        KeyServer.hits = 0
+
+        # the key of the issuer is fetched once
+        for i in range(3):
+            self.assertEqual(db.verify(assertion, audience)[0], 't@m.com')
+        self.assertEqual(KeyServer.hits, 1)
+
+        # then again once it's too old
+        time.sleep(.15)
+        db.verify(assertion, audience)
+        self.assertEqual(KeyServer.hits, 2)
+
+        # forged assertions are rejected
+        assertion = DummyVerifier.make_assertion('t@m.com', audience,
+                                                 assertion_sig='forged')
+        self.assertRaises(StorageAuthError, db.verify, assertion, audience)
+
+    def test_unreachable_issuer(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, verifier='local',
+                         verifier_error_ttl='0.1',
+                         verifier_urlopen='appsync.tests.test_sql.urlopen')
+        db.cache = FakeCache()
+        audience = 'http://myapps.mozillalabs.com/'
+        assertion = DummyVerifier.make_assertion('t@m.com', audience)
+        KeyServer.hits = 0
+        KeyServer.down = True
+        try:
+            # the server is unavailable, and the issuer isn't asked again
+            # for a while
+            for i in range(3):
+                self.assertRaises(ConnectionError, db.verify, assertion,
+                                  audience)
+            self.assertEqual(KeyServer.hits, 1)
+        finally:
+            KeyServer.down = False
+
+        time.sleep(.15)
+        self.assertEqual(db.verify(assertion, audience)[0], 't@m.com')
+        self.assertEqual(KeyServer.hits, 2)
+
+    def test_metadata_cache(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, cache_activated='true')
+        db.set_authentication(False)
+        db.cache = FakeCache()
+        queries = []
+        execute = db._execute
+
+        def _execute(query, *args, **kw):
+            queries.append(query)
+            return execute(query, *args, **kw)
+
+        db._execute = _execute
+
+        db.add_applications('tarek', 'apps', [{'origin': 'app1'}], None)
+        uuid, last_modified, apps = db.get_collection_snapshot(
+                'tarek', 'apps', 0, None)
+        self.assertEqual(len(list(apps)), 1)
+
+        # the polls are answered by the cache, once the write guard expired
+        db.cache.clear()
+        db.get_uuid('tarek', 'apps', None)
+        del queries[:]
+        self.assertEqual(db.get_uuid('tarek', 'apps', None), uuid)
+        self.assertEqual(db.get_last_modified('tarek', 'apps', None),
+                         last_modified)
+        self.assertEqual(db.get_collection_snapshot('tarek', 'apps',
+                                                    last_modified, None),
+                         (uuid, last_modified, []))
+        self.assertEqual(list(db.get_applications('tarek', 'apps',
+                                                  last_modified, None)), [])
+        self.assertEqual(queries, [])
+
+        # the writes update it
+        time.sleep(.01)
+        db.add_applications('tarek', 'apps', [{'origin': 'app2'}], None)
+        __, __, apps = db.get_collection_snapshot('tarek', 'apps',
+                                                  last_modified, None)
+        self.assertEqual([pair[1] for pair in apps], [{'origin': 'app2'}])
+
+        db.delete('tarek', 'apps', 'client', 'reason', None)
+        self.assertRaises(CollectionDeletedError, db.get_applications,
+                          'tarek', 'apps', 0, None)
+        db.cache.clear()
+        self.assertRaises(CollectionDeletedError, db.get_applications,
+                          'tarek', 'apps', 0, None)
+        del queries[:]
+        self.assertRaises(CollectionDeletedError, db.get_applications,
+                          'tarek', 'apps', 0, None)
+        self.assertEqual(queries, [])
+
+    def test_metadata_race(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, cache_activated='true')
+        db.set_authentication(False)
+        db.cache = FakeCache()
+        db.add_applications('tarek', 'apps', [{'origin': 'app1'}], None)
+        db.cache.clear()
+
+        # a reader reads the metadata just before a write
+        key = sql._meta_key('tarek', 'apps')
+        old = db._read_metadata('tarek', 'apps')
+        time.sleep(.01)
+        db.add_applications('tarek', 'apps', [{'origin': 'app2'}], None)
+
+        # and caches them after: they are not used
+        db._cache_metadata(key, old)
+        last_modified = db.get_last_modified('tarek', 'apps', None)
+        self.assertTrue(last_modified > old['last_modified'] / 100.)
+        self.assertEqual(db.cache[key], sql._WRITTEN)
+
+    def test_one_round_trip(self):
+        db = SQLDatabase(sqluri='sqlite:///' + _DB, cache_activated='true')
+        calls = []
+
+        class CountingCache(FakeCache):
+            def get(self, key):
+                calls.append(key)
+                return FakeCache.get(self, key)
+
+            def get_multi(self, keys):
+                calls.append(keys)
+                return FakeCache.get_multi(self, keys)
+
+        db.cache = CountingCache()
+        db.cache.set('token', ('t@m.com', 'audience'))
+        db.add_applications('tarek', 'apps', [{'origin': 'app1'}], 'token')
+
+        # the token and the metadata are read at once
+        del calls[:]
+        __, last_modified, __ = db.get_collection_snapshot('tarek', 'apps', 0,
+                                                           'token')
+        db.get_last_modified('tarek', 'apps', 'token')
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(all(isinstance(call, list) for call in calls))
+
+        self.assertRaises(StorageAuthError, db.get_uuid, 'tarek', 'apps',
+                          'unknown')
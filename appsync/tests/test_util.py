@@ -1,7 +1,10 @@
+import time
 import unittest
 import json
 
-from appsync.util import urlb64decode
+from appsync.metrics import metrics
+from appsync.util import (urlb64decode, TokenSigner, RefreshedValue,
+                          constant_time_compare)
 
 
 assertion = """\
@@ -15,3 +18,65 @@ class TestUtil(unittest.TestCase):
         keys = decode.keys()
         keys.sort()
         self.assertEqual(keys, ['assertion', 'certificates'])
+
+    def test_token_signer(self):
+        signer = TokenSigner('secret')
+        token = signer.sign('t@m.com', 'audience')
+        self.assertEqual(signer.verify(token), ('t@m.com', 'audience'))
+
+        # tampered, badly formed or forged tokens
+        payload, signature = token.split('.')
+        self.assertEqual(signer.verify(payload[:-4] + '.' + signature), None)
+        self.assertEqual(signer.verify('xxx'), None)
+        self.assertEqual(signer.verify(TokenSigner('other').sign('t@m.com',
+                                                                 'a')), None)
+
+        # expired tokens
+        expired = TokenSigner('secret', ttl=-1).sign('t@m.com', 'audience')
+        self.assertEqual(signer.verify(expired), None)
+
+        # the old secret is still accepted after a rotation
+        rotated = TokenSigner('new, secret')
+        self.assertEqual(rotated.verify(token), ('t@m.com', 'audience'))
+        new_token = rotated.sign('t@m.com', 'audience')
+        self.assertEqual(signer.verify(new_token), None)
+
+    def test_constant_time_compare(self):
+        self.assertTrue(constant_time_compare('abc', 'abc'))
+        self.assertFalse(constant_time_compare('abc', 'abd'))
+        self.assertFalse(constant_time_compare('abc', 'ab'))
+
+    def test_refreshed_value(self):
+        values = [1]
+
+        def fetch():
+            if not values:
+                raise ValueError('Boom')
+            return values.pop()
+
+        # fetched by get() once expired
+        value = RefreshedValue('test', fetch, .1, background=False)
+        self.assertEqual(value.get(), 1)
+        values.append(2)
+        self.assertEqual(value.get(), 1)
+        time.sleep(.11)
+        self.assertEqual(value.get(), 2)
+
+        # the errors are counted, the last value is kept
+        metrics.reset()
+        try:
+            for i in range(2):
+                time.sleep(.11)
+                self.assertEqual(value.get(), 2)
+            self.assertEqual(metrics.snapshot()['counters']['test.errors'],
+                             2)
+        finally:
+            metrics.reset()
+
+        # fetched by a thread
+        values.append(3)
+        value = RefreshedValue('test', fetch, .05)
+        self.assertEqual(value.get(), 3)
+        values.append(4)
+        time.sleep(.12)
+        self.assertEqual(value.value, 4)
@@ -3,11 +3,23 @@ from os import urandom
 import uuid
 import binascii
 import hashlib
+import hmac
+import threading
+import time
+import weakref
 
 from zope.interface.registry import ComponentLookupError
 from webob.exc import HTTPBadRequest
+from vep.utils import unbundle_certs_and_assertion, decode_json_bytes
+from appsync import logger
+from appsync.metrics import metrics
 from appsync.storage import IAppSyncDatabase
 from appsync.cache import IAppCache
+from appsync.notify import INotifier
+
+
+class RawJSON(str):
+    """A JSON document that is already serialized."""
 
 
 def gen_uuid(email, audience):
@@ -19,6 +31,146 @@ def gen_uuid(email, audience):
     return str(uuid.uuid3(uuid.NAMESPACE_DNS, salt + udata))
 
 
+def get_assertion_expiry(assertion):
+    """Returns the time at which a BrowserID assertion, or one of its
+    certificates, expires. Raises a ValueError if it is malformed.
+    """
+    try:
+        certificates, assertion = unbundle_certs_and_assertion(assertion)
+        tokens = list(certificates) + [assertion]
+        expiries = [decode_json_bytes(token.split('.')[1])['exp']
+                    for token in tokens]
+    except (TypeError, KeyError, IndexError), e:
+        raise ValueError(str(e))
+    # the expiry dates are in milliseconds
+    return min(expiries) / 1000.
+
+
+def constant_time_compare(one, other):
+    """Compares two strings in a time that doesn't depend on where
+    they differ.
+    """
+    if len(one) != len(other):
+        return False
+    result = 0
+    for x, y in zip(one, other):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class TokenSigner(object):
+    """Issues and checks signed tokens that expire after `ttl` seconds.
+
+    The tokens are signed with the first of `secrets`. The other ones are
+    only used to check the tokens, so a new secret can be put first while
+    the tokens signed with the previous one are still accepted.
+    """
+    def __init__(self, secrets, ttl=300):
+        if isinstance(secrets, basestring):
+            secrets = [secret.strip() for secret in secrets.split(',')]
+        self.secrets = [secret for secret in secrets if secret]
+        if not self.secrets:
+            raise ValueError('At least one secret is needed')
+        self.ttl = ttl
+
+    def _sign(self, secret, payload):
+        return hmac.new(secret, payload, hashlib.sha256).digest()
+
+    def sign(self, email, audience):
+        """Returns a token for that user & audience"""
+        expires = int(time.time() + self.ttl)
+        payload = '\n'.join([email, audience, str(expires)])
+        signature = self._sign(self.secrets[0], payload)
+        return '%s.%s' % (base64.urlsafe_b64encode(payload),
+                          base64.urlsafe_b64encode(signature))
+
+    def verify(self, token):
+        """Returns the (email, audience) of a valid token, or None"""
+        try:
+            payload, signature = token.split('.')
+            payload = base64.urlsafe_b64decode(payload)
+            signature = base64.urlsafe_b64decode(signature)
+            email, audience, expires = payload.split('\n')
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return None
+
+        if expires < time.time():
+            return None
+
+        for secret in self.secrets:
+            if constant_time_compare(self._sign(secret, payload),
+                                     signature):
+                return email, audience
+        return None
+
+
+def _refresh_loop(ref, interval):
+    # stops once the value is not used anymore
+    while True:
+        time.sleep(interval)
+        value = ref()
+        if value is None:
+            return
+        value.refresh()
+        del value
+
+
+class RefreshedValue(object):
+    """A value fetched again every `interval` seconds, and kept in memory
+    meanwhile.
+
+    With `background`, a thread fetches the value, so only the first get()
+    waits for it. Otherwise get() fetches it once it expired, while the
+    other threads keep using the previous value.
+
+    When the value can't be fetched the previous one is kept, and the
+    error is logged once every `error_interval` seconds at most. The
+    errors are counted under <name>.errors.
+    """
+    def __init__(self, name, fetch, interval=60, background=True,
+                 error_interval=60):
+        self.name = name
+        self.fetch = fetch
+        self.interval = interval
+        self.background = background
+        self.error_interval = error_interval
+        self.value = None
+        self._expires = 0
+        self._last_error = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        self._expires = time.time() + self.interval
+        try:
+            self.value = self.fetch()
+        except Exception, e:
+            metrics.incr(self.name + '.errors')
+            now = time.time()
+            if now - self._last_error >= self.error_interval:
+                self._last_error = now
+                logger.error('Could not refresh %s: %s' % (self.name, e))
+
+    def get(self):
+        if self.background:
+            if self._thread is None:
+                with self._lock:
+                    if self._thread is None:
+                        self.refresh()
+                        self._thread = threading.Thread(
+                                target=_refresh_loop,
+                                args=(weakref.ref(self), self.interval))
+                        self._thread.daemon = True
+                        self._thread.start()
+        elif time.time() >= self._expires and self._lock.acquire(False):
+            try:
+                self.refresh()
+            finally:
+                self._lock.release()
+        return self.value
+
+
 def get_storage(request):
     """Get the active storage backend for the given request."""
     return request.registry.getUtility(IAppSyncDatabase)
@@ -32,6 +184,14 @@ def get_cache(request):
         return None
 
 
+def get_notifier(request):
+    """Get the active changes notifier for the given request."""
+    try:
+        return request.registry.getUtility(INotifier)
+    except ComponentLookupError:
+        return None
+
+
 def bad_request(code, msg=''):
     """Creates a 400 response with a json body
     containing an error code and a message
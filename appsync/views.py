@@ -1,21 +1,28 @@
 import urllib
 import time
+import threading
+from contextlib import contextmanager
+from itertools import chain, islice
 try:
     import simplejson as json
 except ImportError:
     import json     # NOQA
 
 from cornice import Service
+from pyramid.settings import asbool
 from mozsvc.util import round_time
 from webob import exc
 
 from appsync import logger
-from appsync.util import get_storage, get_cache, bad_request
-from appsync.cache import CacheError
-from appsync.storage import CollectionDeletedError
+from appsync.metrics import metrics
+from appsync.poll import PollPolicy
+from appsync.util import (get_storage, get_cache, get_notifier, bad_request,
+                          RawJSON)
+from appsync.storage import CollectionDeletedError, MAX_KEY_LENGTH
 from appsync.auth import create_auth, check_auth
 from appsync.respcodes import (INVALID_JSON, INVALID_SINCE_VALUE,
-                               MISSING_VALUE)
+                               MISSING_VALUE, INVALID_TIMEOUT_VALUE,
+                               INVALID_ORIGIN)
 
 
 #
@@ -90,6 +97,116 @@ def verify_(request):
 #
 
 
+# size of the chunks written by the streaming encoder
+_CHUNK_SIZE = 64 * 1024
+
+
+class _Page(object):
+    """Iterates over the (last_modified, app) pairs of a response.
+
+    The iteration stops after `max_apps` apps (if not 0), but never
+    between two apps modified at the same time, since clients ask for
+    the next page with since={until}.  The applications must be sorted
+    by modification time.
+    """
+    def __init__(self, applications, since, max_apps=0):
+        self._applications = applications
+        self._max_apps = max_apps
+        self.until = since
+        self.incomplete = False
+
+    def __iter__(self):
+        count = 0
+        for last_modified, app in self._applications:
+            full = self._max_apps and count >= self._max_apps
+            if full and last_modified > self.until:
+                self.incomplete = True
+                break
+            if last_modified > self.until:
+                self.until = last_modified
+            count += 1
+            yield app
+
+
+def _json_chunks(res, page):
+    """Serializes a response in chunks, as the apps of the page are read.
+
+    RawJSON apps are spliced in as they are.  The `until` and
+    `incomplete` keys are written last, once the page was read.
+
+    When streamed, the 200 status is sent before the apps are read: if
+    the storage fails meanwhile, the error is logged and the body is cut
+    short, which the clients can't parse and retry.
+    """
+    body = json.dumps(res, use_decimal=True)
+    chunk = [body[:-1], ', "applications": [']
+    size = 0
+    try:
+        for index, app in enumerate(page):
+            if not isinstance(app, RawJSON):
+                app = json.dumps(app, use_decimal=True)
+            if index > 0:
+                chunk.append(', ')
+            chunk.append(app)
+            size += len(app)
+            if size > _CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+    except Exception:
+        logger.error('The applications could not be read, the response '
+                     'is truncated')
+        raise
+
+    tail = {'until': page.until}
+    if page.incomplete:
+        tail['incomplete'] = True
+    chunk.append('], ' + json.dumps(tail, use_decimal=True)[1:])
+    yield ''.join(chunk)
+
+
+def _get_poll_policy(request):
+    registry = request.registry
+    policy = registry.get('poll_policy')
+    if policy is None:
+        policy = PollPolicy.from_settings(registry.settings)
+        registry['poll_policy'] = policy
+    return policy
+
+
+def _set_poll_interval(request, start, last_modified=None):
+    # do we want to add a X-Sync-Poll ?
+    policy = _get_poll_policy(request)
+    policy.load.record(time.time() - start)
+    poll_interval = policy.get_interval(get_cache(request), last_modified)
+    if poll_interval is not None:
+        request.response.headers['X-Sync-Poll'] = str(poll_interval)
+
+
+def _get_since(request):
+    try:
+        since = request.GET.get('since', '0')
+        since = round_time(since)
+    except TypeError:
+        raise bad_request(INVALID_SINCE_VALUE)
+    except ValueError:
+        logger.error('Bad since %r' % since)
+        raise bad_request(INVALID_SINCE_VALUE,
+                          'Invalid value for since: %r' % since)
+
+    if since.is_nan():
+        raise bad_request(INVALID_SINCE_VALUE,
+                          'Got NaN value for since')
+    return since
+
+
+def _get_etag(uuid, last_modified):
+    # the collection changes when it's updated or deleted and recreated
+    if last_modified is None:
+        return None
+    return '%s-%s' % (uuid, last_modified)
+
+
 data = Service(name='data', path='/collections/{user}/{collection}',
                description='Used to get and set the apps')
 
@@ -122,6 +239,11 @@ def get_data(request):
 
         {until: timestamp}
 
+    The response may have an `ETag` header.  If the client sends it back
+    in `If-None-Match` and there are no new items, the response is an
+    empty 304.  It spares the storage queries only when the metadata of
+    the collections are cached (`cache_activated`).
+
     The client should always start with this GET request and only then send
     its own updates.  It should ensure that its local timestamp is
     sensible in comparison to the value of `until`.
@@ -146,58 +268,72 @@ def get_data(request):
     the server (unless you ignore the application in favor of a
     newer local version).
     """
+    start = time.time()
     user, collection, dbtoken = check_auth(request)
+    since = _get_since(request)
 
-    try:
-        since = request.GET.get('since', '0')
-        since = round_time(since)
-    except TypeError:
-        raise bad_request(INVALID_SINCE_VALUE)
-    except ValueError:
-        logger.error('Bad since %r' % since)
-        raise bad_request(INVALID_SINCE_VALUE,
-                          'Invalid value for since: %r' % since)
-
-    if since.is_nan():
-        raise bad_request(INVALID_SINCE_VALUE,
-                          'Got NaN value for since')
-
+    settings = request.registry.settings
+    max_apps = int(settings.get('global.max_applications', 0))
+    stream = asbool(settings.get('global.stream_applications', False))
     storage = get_storage(request)
 
-    res = {'since': since,
-           'uuid': storage.get_uuid(user, collection, dbtoken)}
-    until = 0
-    apps = []
-    try:
-        for index, (last_modified, app) in enumerate(
-                storage.get_applications(user, collection, since,
-                                         token=dbtoken)):
-            if last_modified > until:
-                until = last_modified
-
-            apps.append(app)
-
-        res['applications'] = apps
-        if not until:
-            until = since
-        res['until'] = until
+    # without a snapshot, only read for the adaptive poll interval
+    last_modified = None
 
+    try:
+        # backends can fetch everything at once
+        if hasattr(storage, 'get_collection_snapshot'):
+            uuid, last_modified, applications = \
+                    storage.get_collection_snapshot(user, collection, since,
+                                                    token=dbtoken)
+        else:
+            uuid = storage.get_uuid(user, collection, dbtoken)
+            applications = storage.get_applications(user, collection, since,
+                                                    token=dbtoken)
+            if _get_poll_policy(request).adaptive:
+                last_modified = storage.get_last_modified(user, collection,
+                                                          token=dbtoken)
+
+        # the applications may be an iterator: reading the first one
+        # now raises the storage errors before we start answering
+        applications = iter(applications)
+        first = list(islice(applications, 1))
     except CollectionDeletedError, e:
         return {'collection_deleted': {'reason': e.reason,
                                        'client_id': e.client_id}}
 
-    # do we want to add a X-Sync-Poll ?
-    cache = get_cache(request)
-    if cache is not None:
-        try:
-            poll_interval = cache.get('X-Sync-Poll')
-        except CacheError, e:
-            # a well, nevermind then
-            logger.error(str(e))
+    _set_poll_interval(request, start, last_modified)
+
+    etag = _get_etag(uuid, last_modified)
+    if etag is not None:
+        request.response.etag = etag
+        # the client already has everything. With the metadata cache of
+        # the SQL backend, the storage was not queried to get here;
+        # without it, the snapshot query ran but only read the metadata
+        # row, since no app was modified after `since`
+        if not first and etag in request.if_none_match:
+            response = request.response
+            response.status = 304
+            del response.content_type
+            return response
+
+    res = {'since': since, 'uuid': uuid}
+    page = _Page(chain(first, applications), since, max_apps)
+
+    # the backend may return serialized apps we don't want to parse
+    if stream or (first and isinstance(first[0][1], RawJSON)):
+        response = request.response
+        response.content_type = 'application/json'
+        if stream:
+            response.app_iter = _json_chunks(res, page)
         else:
-            if poll_interval is not None:
-                request.response.headers['X-Sync-Poll'] = str(poll_interval)
+            response.body = ''.join(_json_chunks(res, page))
+        return response
 
+    res['applications'] = list(page)
+    res['until'] = page.until
+    if page.incomplete:
+        res['incomplete'] = True
     return res
 
 
@@ -244,6 +380,7 @@ def post_data(request):
         client_id = info['client_id']
         reason = info.get('reason', '')
         storage.delete(user, collection, client_id, reason, token=dbtoken)
+        _publish(request, user, collection)
         return {'received': server_time}
 
     elif 'lastget' in request.params:
@@ -258,14 +395,165 @@ def post_data(request):
     except ValueError:
         raise bad_request(INVALID_JSON)
 
+    # the storage can't tell apart origins longer than it indexes
+    for app in apps:
+        origin = app.get('origin')
+        if not origin or len(origin) > MAX_KEY_LENGTH:
+            raise bad_request(INVALID_ORIGIN)
+
     # in case this fails, the error will get logged
     # and the user will get a 503 (empty body)
 
     storage.add_applications(user, collection, apps, token=dbtoken)
+    _publish(request, user, collection)
 
     return {'received': server_time}
 
 
+def _publish(request, user, collection):
+    notifier = get_notifier(request)
+    if notifier is not None:
+        notifier.publish(user, collection)
+
+
+changes = Service(name='changes',
+                  path='/collections/{user}/{collection}/changes',
+                  description='Used to wait for the changes of the apps')
+
+
+# the number of requests waiting for changes in this process
+_waiting = 0
+_waiting_lock = threading.Lock()
+
+
+@contextmanager
+def _park(limit):
+    """Counts a waiting request, if there are less than `limit` of them.
+
+    Yields False when the request can't wait.
+    """
+    global _waiting
+    with _waiting_lock:
+        parked = _waiting < limit
+        if parked:
+            _waiting += 1
+    try:
+        yield parked
+    finally:
+        if parked:
+            with _waiting_lock:
+                _waiting -= 1
+
+
+def _wait_for_changes(request, user, collection, since, timeout, dbtoken):
+    """Waits until the collection changes, or for `timeout` seconds.
+
+    The changes made by this process wake us up right away, the other
+    ones are found by checking the storage every `longpoll_recheck`
+    seconds.
+    """
+    settings = request.registry.settings
+    recheck = float(settings.get('global.longpoll_recheck', 5))
+    storage = get_storage(request)
+    notifier = get_notifier(request)
+    deadline = time.time() + timeout
+
+    while True:
+        with _listen(notifier, user, collection) as changed:
+            if _has_changed(storage, user, collection, since, dbtoken):
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # wait() returns None on Python 2.6
+            changed.wait(min(remaining, recheck))
+            if changed.is_set():
+                return
+
+
+def _has_changed(storage, user, collection, since, dbtoken):
+    """Tells if an app was modified after `since`, or if the collection
+    was deleted.
+    """
+    try:
+        if hasattr(storage, 'get_collection_snapshot'):
+            __, __, applications = \
+                    storage.get_collection_snapshot(user, collection, since,
+                                                    token=dbtoken)
+        else:
+            applications = storage.get_applications(user, collection, since,
+                                                    token=dbtoken)
+    except CollectionDeletedError:
+        return True
+
+    applications = iter(applications)
+    try:
+        return len(list(islice(applications, 1))) > 0
+    finally:
+        # releases the cursor of the lazy results
+        if hasattr(applications, 'close'):
+            applications.close()
+
+
+@contextmanager
+def _listen(notifier, user, collection):
+    if notifier is None:
+        # nobody will wake us up
+        yield threading.Event()
+    else:
+        with notifier.listen(user, collection) as changed:
+            yield changed
+
+
+@changes.get()
+def get_changes(request):
+    """Waits for the collection to change before answering::
+
+        GET /collections/{user}/{collection}/changes?since=timestamp&timeout=30
+
+    The request is parked until an application is modified after `since`,
+    or until `timeout` seconds have passed.  `timeout` can't be over the
+    `longpoll_timeout` option of the server (30 seconds by default), which
+    is also its default value.
+
+    Unless the `longpoll` option of the server is set, or when
+    `longpoll_max_waiting` requests are already parked in the process,
+    the request is answered right away.
+
+    The response is the same as the one of a `GET` on the collection, so
+    it is empty when nothing changed.  The client can send its next
+    request right away.
+    """
+    user, collection, dbtoken = check_auth(request)
+    since = _get_since(request)
+
+    settings = request.registry.settings
+    max_timeout = float(settings.get('global.longpoll_timeout', 30))
+    timeout = request.GET.get('timeout', max_timeout)
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise bad_request(INVALID_TIMEOUT_VALUE,
+                          'Invalid value for timeout: %r' % timeout)
+    if not 0 <= timeout:
+        raise bad_request(INVALID_TIMEOUT_VALUE,
+                          'Invalid value for timeout: %r' % timeout)
+    timeout = min(timeout, max_timeout)
+
+    # each waiting request holds a worker
+    if not asbool(settings.get('global.longpoll', False)):
+        timeout = 0
+    limit = int(settings.get('global.longpoll_max_waiting', 10))
+
+    with _park(limit) as parked:
+        if parked:
+            _wait_for_changes(request, user, collection, since, timeout,
+                              dbtoken)
+        else:
+            metrics.incr('longpoll.full')
+    return get_data(request)
+
+
 heartbeat = Service(name='heartbeat', path='/__heartbeat__')
 
 
@@ -275,3 +563,14 @@ def check_health(request, renderer='string'):
     # XXX See if we want to add a backend check here
     # Services Ops would say no
     return 'OK'
+
+
+stats = Service(name='stats', path='/__stats__')
+
+
+@stats.get()
+def get_stats(request):
+    """Returns the metrics of this process, when global.stats is set"""
+    if not asbool(request.registry.settings.get('global.stats', False)):
+        raise exc.HTTPForbidden()
+    return metrics.snapshot()
@@ -0,0 +1,73 @@
+""" Measures the reads of a collection stored in Sauropod.
+
+Usage: python sauropodbench.py [apps] [delay] [concurrency]
+
+A stand-in Sauropod server answering every read after `delay` seconds
+(default: 0.01) is started locally, a collection of `apps` applications
+(default: 300) is stored in it, then the collection is read with the
+items fetched one at a time, then `concurrency` at a time (default: 10).
+"""
+import sys
+import time
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import vep
+
+from appsync.storage.sauropod import SauropodDatabase
+from appsync.tests.test_sauropod import FakeSauropod
+
+
+PORT = 9999
+AUDIENCE = 'http://myapps.mozillalabs.com/'
+
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve():
+    server = make_server('localhost', PORT, FakeSauropod(),
+                         server_class=ThreadingServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def bench(storage, token, concurrency):
+    storage.fetch_concurrency = concurrency
+    start = time.time()
+    apps = list(storage.get_applications('t@m.com', 'apps', 0, token))
+    return len(apps), time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    FakeSauropod.delay = float(sys.argv[2]) if len(sys.argv) > 2 else .01
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    serve()
+    storage = SauropodDatabase('http://localhost:%d' % PORT,
+                               'https://myapps.mozillalabs.com',
+                               fetch_concurrency=concurrency)
+    assertion = vep.DummyVerifier.make_assertion('t@m.com', AUDIENCE)
+    __, token = storage.verify(assertion, AUDIENCE)
+
+    apps = [{'origin': 'https://app%d.example.com' % i} for i in range(count)]
+    storage.add_applications('t@m.com', 'apps', apps, token)
+
+    for size in (1, concurrency):
+        read, duration = bench(storage, token, size)
+        print 'Concurrency %d: %d apps read in %.2f s' % (size, read,
+                                                          duration)
+
+
+if __name__ == '__main__':
+    main()
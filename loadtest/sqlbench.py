@@ -0,0 +1,93 @@
+""" Measures the SQL polling queries on a large applications table.
+
+Usage: python sqlbench.py [rows] [sqluri]
+
+The table is filled with `rows` applications (100 per collection), then
+the queries run by a poll are timed before and after the indexes are
+created.
+"""
+import os
+import sys
+import time
+import random
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql.expression import text
+
+from appsync.storage import queries
+from appsync.storage.sql import _TABLES, applications, create_indexes
+
+
+APPS_PER_COLLECTION = 100
+POLLS = 200
+
+
+def fill(engine, rows):
+    for table in _TABLES:
+        table.create(bind=engine, checkfirst=True)
+        for index in table.indexes:
+            index.drop(bind=engine)
+
+    conn = engine.connect()
+    trans = conn.begin()
+    batch = []
+    for row in xrange(rows):
+        user = 'user%d@moz.com' % (row // APPS_PER_COLLECTION)
+        origin = 'https://app%d.example.com' % (row % APPS_PER_COLLECTION)
+        batch.append({'user': user, 'collection': 'apps', 'origin': origin,
+                      'last_modified': 132000000000 + row,
+                      'data': '{"origin": "%s"}' % origin})
+        if len(batch) == 10000:
+            conn.execute(applications.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(applications.insert(), batch)
+    trans.commit()
+    conn.close()
+
+
+def poll(engine, users):
+    user = 'user%d@moz.com' % random.randint(0, users - 1)
+    params = {'user': user, 'collection': 'apps'}
+    last_modified = engine.execute(text(queries.LAST_MODIFIED),
+                                   **params).fetchone().last_modified
+    engine.execute(text(queries.GET_QUERY), since=last_modified - 10,
+                   **params).fetchall()
+    engine.execute(text(queries.GET_BY_ORIGIN_QUERY),
+                   origin='https://app1.example.com', **params).fetchall()
+
+
+def bench(engine, users, polls=POLLS):
+    start = time.time()
+    for i in range(polls):
+        poll(engine, users)
+    return (time.time() - start) / polls * 1000
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        sqluri = sys.argv[2]
+    else:
+        sqluri = 'sqlite:////tmp/appsync-bench.db'
+        if os.path.exists('/tmp/appsync-bench.db'):
+            os.remove('/tmp/appsync-bench.db')
+
+    engine = create_engine(sqluri)
+    users = max(rows // APPS_PER_COLLECTION, 1)
+
+    print 'Filling the applications table with %d rows...' % rows
+    fill(engine, rows)
+
+    # a full scan is slow, let's not wait forever for it
+    print 'Without indexes: %.2f ms per poll' % bench(engine, users, 10)
+
+    start = time.time()
+    create_indexes(engine)
+    print 'Creating the indexes took %.1f s' % (time.time() - start)
+
+    print 'With indexes: %.2f ms per poll' % bench(engine, users)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,7 @@ setup(name='appsync',
 
       [console_scripts]
       appsync-backoff = appsync.scripts.backoff:main
+      appsync-migrate = appsync.scripts.migrate:main
       """,
       paster_plugins=['pyramid'],
       )